@@ -0,0 +1,87 @@
+import re
+import time
+import html
+import argparse
+import itertools
+from trial_discovery import discover_trials
+from criteria_sections import segment_batch, criteria_texts
+
+
+# Throughput benchmark of the inclusion/exclusion segmenter over a ClinicalTrials.gov dump, compared with
+# the per-block splitting read_trial used before. Reading the files is timed separately from segmenting.
+
+textblock_pattern = re.compile(r'<eligibility>.*?<criteria>\s*<textblock>(.*?)</textblock>', re.S)
+
+
+def read_criteria_blocks(filename):
+    with open(filename, 'r') as f:
+        trial_data = f.read()
+    return [html.unescape(block) for block in textblock_pattern.findall(trial_data)]
+
+
+def legacy_split(blocks):
+    in_criteria_text = None
+    ex_criteria_text = None
+    for criteria_text_block in blocks:
+        if 'inclusion criteria' in criteria_text_block.lower() and 'exclusion criteria' in criteria_text_block.lower():
+            splits_by_inclusion = re.split('Inclusion Criteria|Inclusion criteria|inclusion criteria|inclusion Criteria|INCLUSION CRITERIA', criteria_text_block, 1)
+            text_following_inclusion = splits_by_inclusion[1]
+            splits_by_exclusion = re.split('Exclusion Criteria|Exclusion criteria|exclusion criteria|exclusion Criteria|EXCLUSION CRITERIA',
+                                           text_following_inclusion, 1)
+            in_criteria_text = splits_by_exclusion[0].strip()
+            ex_criteria_text = splits_by_exclusion[1].strip()
+    return in_criteria_text, ex_criteria_text
+
+
+def coverage(results):
+    counts = {'both': 0, 'inclusion only': 0, 'exclusion only': 0, 'none': 0}
+    for in_text, ex_text in results:
+        if in_text is not None and ex_text is not None:
+            counts['both'] += 1
+        elif in_text is not None:
+            counts['inclusion only'] += 1
+        elif ex_text is not None:
+            counts['exclusion only'] += 1
+        else:
+            counts['none'] += 1
+    return counts
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the inclusion/exclusion criteria segmenter.')
+    parser.add_argument('-input_file', '--input_xml_file', required=True,
+                        help='Directory of xml files containing raw clinical trial data (searched recursively)')
+    parser.add_argument('-limit', '--max_trials', type=int, default=None,
+                        help='Only benchmark the first this many trials')
+    parser.add_argument('-batch_size', '--batch_size', type=int, default=64,
+                        help='Number of trials segmented per scan')
+    args = parser.parse_args()
+
+    start = time.time()
+    trials = [read_criteria_blocks(filename)
+              for filename in itertools.islice(discover_trials(args.input_xml_file), args.max_trials)]
+    read_time = time.time() - start
+    n_bytes = sum(len(block) for blocks in trials for block in blocks)
+    print('Read {} trials ({:.1f} MB of criteria text) in {:.1f}s'.format(len(trials), n_bytes / 1e6, read_time))
+
+    start = time.time()
+    legacy_results = [legacy_split(blocks) for blocks in trials]
+    legacy_time = time.time() - start
+
+    start = time.time()
+    results = []
+    for i in range(0, len(trials), args.batch_size):
+        batch = trials[i:i + args.batch_size]
+        # all blocks of the batch in one scan, then regrouped per trial
+        block_sections = segment_batch([block for blocks in batch for block in blocks])
+        position = 0
+        for blocks in batch:
+            sections = [section for s in block_sections[position:position + len(blocks)] for section in s]
+            position += len(blocks)
+            results.append(criteria_texts(sections))
+    segment_time = time.time() - start
+
+    for name, elapsed, method_results in (('legacy split', legacy_time, legacy_results), ('segmenter', segment_time, results)):
+        print('{}: {:.2f}s, {:.0f} trials/s, {:.1f} MB/s -- {}'.format(
+            name, elapsed, len(trials) / max(elapsed, 1e-9), n_bytes / 1e6 / max(elapsed, 1e-9), coverage(method_results)))
@@ -0,0 +1,199 @@
+import re
+import json
+import random
+import hashlib
+import logging
+import threading
+from sqlite_util import connect
+
+
+# MinHash signatures of num_perm values split into lsh_bands bands; two chunks become LSH candidates when
+# all values of at least one band agree. With 32 bands of 4 rows, chunks with a Jaccard similarity of 0.6
+# are candidates with probability ~0.99, and candidates are then checked against the reuse threshold.
+num_perm = 128
+lsh_bands = 32
+mersenne_prime = (1 << 61) - 1
+max_hash = (1 << 32) - 1
+# fixed seed: signatures are stored in the index and compared across runs
+_random = random.Random(1)
+permutations = [(_random.randrange(1, mersenne_prime), _random.randrange(0, mersenne_prime)) for _ in range(num_perm)]
+
+# a line break, or the end of a sentence (but not the period of a "1." list number)
+unit_split_pattern = re.compile(r'\n+|(?<=[^\d\s][.?;])\s+')
+list_marker_pattern = re.compile(r'^(?:[-*•]|\(?\d{1,3}[.)]|\(?[a-z][.)])\s+')
+
+schema = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    item TEXT NOT NULL,
+    signature TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunk_bands (
+    band_key TEXT NOT NULL,
+    chunk_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunk_bands_key ON chunk_bands (band_key);
+CREATE TABLE IF NOT EXISTS chunk_units (
+    chunk_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    unit TEXT NOT NULL,
+    criteria TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunk_units_chunk_id ON chunk_units (chunk_id);
+"""
+
+
+def normalize_unit(unit):
+    # numbering, list markers, case, whitespace and trailing punctuation do not change what is extracted
+    unit = ' '.join(unit.lower().split())
+    unit = list_marker_pattern.sub('', unit)
+    unit = unit.strip(' .;:')
+    # a list number on a line of its own
+    if re.fullmatch(r'\(?(?:\d{1,3}|[a-z])[.)]?', unit):
+        return ''
+    return unit
+
+
+def split_units(text):
+    # criteria lists are one criterion per line, free text one per sentence; returns (original, normalized) pairs
+    units = []
+    for unit in unit_split_pattern.split(text):
+        normalized = normalize_unit(unit)
+        if normalized:
+            units.append((unit.strip(), normalized))
+    return units
+
+
+def shingles(normalized_units, size=3):
+    words = ' '.join(normalized_units).split()
+    if len(words) < size:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash(shingle_set):
+    hashes = [int.from_bytes(hashlib.sha1(s.encode('utf-8')).digest()[:4], 'little') for s in shingle_set]
+    return [min(((a * h + b) % mersenne_prime) & max_hash for h in hashes) for a, b in permutations]
+
+
+def band_keys(item, signature):
+    rows = num_perm // lsh_bands
+    return ['{}:{}:{}'.format(item, band, hashlib.md5(json.dumps(signature[band * rows:(band + 1) * rows]).encode()).hexdigest()[:16])
+            for band in range(lsh_bands)]
+
+
+def estimated_similarity(signature, other):
+    return sum(1 for x, y in zip(signature, other) if x == y) / float(num_perm)
+
+
+def assign_criteria(normalized_units, criteria):
+    # attributes every extracted criterion to the first unit that contains its "Sentence", or that is a
+    # part of at least three words of it (a "Sentence" spanning several lines); returns the criteria per
+    # unit and the criteria that could not be attributed
+    per_unit = [[] for _ in normalized_units]
+    unassigned = []
+    for extracted_criteria in criteria:
+        sentence = normalize_unit(str(extracted_criteria.get('Sentence', ''))) if isinstance(extracted_criteria, dict) else ''
+        for i, unit in enumerate(normalized_units):
+            if sentence and (sentence in unit or (unit in sentence and len(unit.split()) >= 3)):
+                per_unit[i].append(extracted_criteria)
+                break
+        else:
+            unassigned.append(extracted_criteria)
+    return per_unit, unassigned
+
+
+class ChunkIndex:
+    # Persistent MinHash/LSH index over the normalized chunks that have been extracted, with the
+    # extracted criteria of each chunk attributed to its lines/sentences. For a new chunk whose
+    # nearest indexed chunk (same criteria type) is at least threshold similar, the criteria of the
+    # unchanged units are reused and only the changed units need a fresh extraction.
+    def __init__(self, db_path, threshold=0.8):
+        self.db_path = db_path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.matches = 0
+        self.units_reused = 0
+        self.units_sent = 0
+        self.calls_avoided = 0
+        with connect(self.db_path) as conn:
+            conn.executescript(schema)
+
+    def nearest(self, item, normalized_units):
+        # (chunk_id, similarity) of the most similar indexed chunk above the threshold, or None
+        signature = minhash(shingles(normalized_units))
+        keys = band_keys(item, signature)
+        with connect(self.db_path) as conn:
+            rows = conn.execute('SELECT id, signature FROM chunks WHERE id IN (SELECT chunk_id FROM chunk_bands '
+                                'WHERE band_key IN ({}))'.format(', '.join('?' for _ in keys)), keys).fetchall()
+        best = None
+        for row in rows:
+            similarity = estimated_similarity(signature, json.loads(row['signature']))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (row['id'], similarity)
+        return best
+
+    def lookup(self, item, text):
+        # Returns (reused criteria, original text of the units that need a fresh extraction, similarity);
+        # without a near-duplicate every unit needs a fresh extraction.
+        units = split_units(text)
+        normalized_units = [normalized for _, normalized in units]
+        match = self.nearest(item, normalized_units) if units else None
+        if match is None:
+            with self._lock:
+                self.lookups += 1
+                self.units_sent += len(units)
+            return [], [original for original, _ in units], None
+
+        chunk_id, similarity = match
+        with connect(self.db_path) as conn:
+            prior = conn.execute('SELECT unit, criteria FROM chunk_units WHERE chunk_id = ? ORDER BY position',
+                                 (chunk_id,)).fetchall()
+        prior_units = {}
+        for row in prior:
+            prior_units.setdefault(row['unit'], []).append(json.loads(row['criteria']))
+        reused = []
+        fresh_units = []
+        for original, normalized in units:
+            if prior_units.get(normalized):
+                reused.extend(prior_units[normalized].pop(0))
+            else:
+                fresh_units.append(original)
+        with self._lock:
+            self.lookups += 1
+            self.matches += 1
+            self.units_reused += len(units) - len(fresh_units)
+            self.units_sent += len(fresh_units)
+            self.calls_avoided += int(len(fresh_units) == 0)
+        return reused, fresh_units, similarity
+
+    def add(self, item, text, criteria):
+        units = split_units(text)
+        normalized_units = [normalized for _, normalized in units]
+        if not units:
+            return
+        per_unit, unassigned = assign_criteria(normalized_units, criteria)
+        if unassigned:
+            # reusing this chunk would silently drop these criteria
+            logging.info('Chunk index: {} criteria could not be attributed to a line of the chunk, not indexing it'.format(
+                len(unassigned)))
+            return
+        signature = minhash(shingles(normalized_units))
+        with connect(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            chunk_id = conn.execute('INSERT INTO chunks (item, signature) VALUES (?, ?)',
+                                    (item, json.dumps(signature))).lastrowid
+            conn.executemany('INSERT INTO chunk_bands (band_key, chunk_id) VALUES (?, ?)',
+                             [(key, chunk_id) for key in band_keys(item, signature)])
+            conn.executemany('INSERT INTO chunk_units (chunk_id, position, unit, criteria) VALUES (?, ?, ?, ?)',
+                             [(chunk_id, i, unit, json.dumps(unit_criteria))
+                              for i, (unit, unit_criteria) in enumerate(zip(normalized_units, per_unit))])
+            conn.execute('COMMIT')
+
+    def report(self):
+        total_units = self.units_reused + self.units_sent
+        return ['Chunk reuse: {} of {} chunks matched a near-duplicate, {} of {} lines reused ({:.1%}), '
+                '{} extraction calls avoided'.format(self.matches, self.lookups, self.units_reused, total_units,
+                                                     self.units_reused / total_units if total_units else 0.0,
+                                                     self.calls_avoided)]
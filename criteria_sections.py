@@ -0,0 +1,109 @@
+import re
+import bisect
+
+
+# One precompiled pattern finds every inclusion/exclusion heading variant, e.g. "Inclusion Criteria:",
+# "INCLUSION CRITERIA", "Key Inclusion Criteria:", "Exclusion criteria for Part B:". It is matched against
+# the lowercased text and starts with a literal, so re skips ahead with a fast substring search instead of
+# trying an alternation at every position. heading_start() then checks the context: a heading either
+# starts a line and ends that line or a colon, or starts a sentence and is directly followed by a colon,
+# so sentences and list items that merely mention "inclusion criteria" are not headings.
+heading_pattern = re.compile(r'clusion[ \t]+criteria\b'
+                             r'(?P<label>(?:(?!(?:in|ex)clusion[ \t]+criteria)[^\n:]){0,40}?)[ \t]*(?P<end>:|$)',
+                             re.M)
+# for the rare texts whose length changes when lowercased (offsets would no longer line up)
+heading_pattern_ignorecase = re.compile(heading_pattern.pattern, re.M | re.I)
+
+heading_prefix = r'(?:(?:key|main|major|general|additional|specific|other)[ \t]+)?'
+line_prefix_pattern = re.compile(r'[ \t]*' + heading_prefix, re.I)
+inline_prefix_pattern = re.compile(heading_prefix + r'$', re.I)
+
+# joins the texts of a batch so that one scan covers all of them; no heading can span it
+batch_separator = '\n\x00\n'
+
+kinds = ('in', 'ex')
+
+
+def heading_start(text, match):
+    # (kind, offset where the heading starts including a "Key " prefix), or None when the
+    # match is only a mention of the criteria
+    keyword_start = match.start() - 2
+    kind = text[max(keyword_start, 0):match.start()].lower()
+    if kind not in kinds:
+        return None
+    line_start = text.rfind('\n', 0, keyword_start) + 1
+    before = text[line_start:keyword_start]
+    if line_prefix_pattern.fullmatch(before):
+        return kind, line_start + len(before) - len(before.lstrip())
+    if match.group('end') != ':' or match.group('label').strip():
+        return None
+    heading_begin = keyword_start - len(inline_prefix_pattern.search(before).group(0))
+    # inline, e.g. "... of the study. Exclusion criteria: ...", but not "- Patients not meeting exclusion criteria:"
+    if not text[line_start:heading_begin].rstrip().endswith('.') or not text[heading_begin - 1].isspace():
+        return None
+    return kind, heading_begin
+
+
+def segment_batch(texts):
+    # Splits every eligibility criteria text of the batch into its inclusion/exclusion sections with a
+    # single scan over the joined texts. Returns one list of sections per text; a section is a dict with
+    # its kind ('in' or 'ex'), the heading, and the start/end offsets of the heading and of the section
+    # text in the original text. Text before the first heading is not part of any section.
+    joined = batch_separator.join(texts)
+    starts = []
+    position = 0
+    for text in texts:
+        starts.append(position)
+        position += len(text) + len(batch_separator)
+
+    lowered = joined.lower()
+    if len(lowered) == len(joined):
+        matches = heading_pattern.finditer(lowered)
+    else:
+        matches = heading_pattern_ignorecase.finditer(joined)
+
+    headings = [[] for _ in texts]
+    for match in matches:
+        heading = heading_start(joined, match)
+        if heading is not None:
+            i = bisect.bisect_right(starts, heading[1]) - 1
+            headings[i].append((heading, match.end()))
+
+    results = []
+    for i, text in enumerate(texts):
+        sections = []
+        for n, ((kind, start), end) in enumerate(headings[i]):
+            text_end = headings[i][n + 1][0][1] if n + 1 < len(headings[i]) else starts[i] + len(text)
+            sections.append({'kind': kind,
+                             'heading': joined[start:end].strip(),
+                             'heading_start': start - starts[i],
+                             'start': end - starts[i],
+                             'end': text_end - starts[i],
+                             # a list marker in front of the next heading is not part of this section
+                             'text': joined[end:text_end].strip().rstrip('-*•').strip()})
+        results.append(sections)
+    return results
+
+
+def segment_criteria(text):
+    return segment_batch([text])[0]
+
+
+def segment_blocks(blocks):
+    # sections of all <eligibility> blocks of one trial, each tagged with the index of its block
+    sections = []
+    for block, block_sections in enumerate(segment_batch(blocks)):
+        for section in block_sections:
+            section['block'] = block
+            sections.append(section)
+    return sections
+
+
+def criteria_texts(sections):
+    # (inclusion text, exclusion text); sections of the same kind are joined in order,
+    # and a kind without any non-empty section is None
+    texts = {'in': [], 'ex': []}
+    for section in sections:
+        if section['text']:
+            texts[section['kind']].append(section['text'])
+    return tuple('\n\n'.join(texts[kind]) if texts[kind] else None for kind in kinds)
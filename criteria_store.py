@@ -0,0 +1,193 @@
+import re
+import json
+import math
+import argparse
+from sqlite_util import connect
+
+
+# output columns (see new_trial_output in eligibility_criteria_extraction.py) and their store columns
+columns = {'Trial ID': 'trial_id', 'Type': 'type', 'Phase': 'phase', 'URL': 'url', 'Entity': 'entity',
+           'Attribute': 'attribute', 'Value': 'value', 'Temporal': 'temporal', 'Modifier': 'modifier',
+           'Source Sentence': 'source_sentence'}
+
+schema = """
+CREATE TABLE IF NOT EXISTS criteria (
+    id INTEGER PRIMARY KEY,
+    trial_id TEXT NOT NULL,
+    type TEXT COLLATE NOCASE,
+    phase TEXT,
+    url TEXT,
+    entity TEXT COLLATE NOCASE,
+    attribute TEXT,
+    attribute_norm TEXT,
+    value TEXT COLLATE NOCASE,
+    temporal TEXT,
+    modifier TEXT,
+    source_sentence TEXT
+);
+CREATE INDEX IF NOT EXISTS criteria_trial_id ON criteria (trial_id);
+CREATE INDEX IF NOT EXISTS criteria_attribute ON criteria (attribute_norm, value, type, entity, trial_id);
+CREATE INDEX IF NOT EXISTS criteria_type_entity ON criteria (type, entity, attribute_norm, value, trial_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS criteria_fts USING fts5 (source_sentence, content='criteria', content_rowid='id');
+"""
+
+
+def normalize_attribute(attribute):
+    # "1. Anti-PD-1  therapy" -> "anti pd 1 therapy", so spelling variants of an attribute share one index key
+    if attribute is None:
+        return None
+    attribute = re.sub(r'^\s*(?:[-*•]|\d{1,3}[.)])\s*', '', str(attribute).lower())
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', attribute).split())
+
+
+def _cell(value):
+    # empty excel/dataframe cells come back as NaN
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return str(value)
+
+
+def fts_query(text):
+    # every word of the text must occur in the sentence; quoting keeps FTS5 operators and punctuation literal
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+class CriteriaStore:
+    # SQLite store of the extracted criteria of all trials, indexed on Trial ID, Type, Entity, the
+    # normalized Attribute and Value, with an FTS5 full-text index over the source sentences, so
+    # cohort matching queries do not need to open and scan one workbook sheet per trial. The indexes
+    # end in trial_id, so trial_ids() lookups on those columns never touch the table itself.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with connect(self.db_path) as conn:
+            conn.executescript(schema)
+
+    def write_trial(self, trial_id, rows):
+        # rows: dicts keyed by the output column names; the previous rows of the trial are replaced
+        self.write_trials([(trial_id, rows)])
+
+    def write_trials(self, trials):
+        # (trial_id, rows) pairs, written in a single transaction
+        with connect(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for trial_id, rows in trials:
+                self._replace_trial(conn, trial_id, rows)
+            conn.execute('COMMIT')
+
+    def _replace_trial(self, conn, trial_id, rows):
+        # the full-text index has external content, so the old sentences are removed from it explicitly
+        for old in conn.execute('SELECT id, source_sentence FROM criteria WHERE trial_id = ?', (trial_id,)).fetchall():
+            conn.execute("INSERT INTO criteria_fts (criteria_fts, rowid, source_sentence) VALUES ('delete', ?, ?)",
+                         (old['id'], old['source_sentence']))
+        conn.execute('DELETE FROM criteria WHERE trial_id = ?', (trial_id,))
+        store_columns = list(columns.values()) + ['attribute_norm']
+        values = []
+        for row in rows:
+            row_values = {column: _cell(row.get(name)) for name, column in columns.items()}
+            row_values['trial_id'] = trial_id
+            row_values['attribute_norm'] = normalize_attribute(row_values['attribute'])
+            values.append([row_values[column] for column in store_columns])
+        conn.executemany('INSERT INTO criteria ({}) VALUES ({})'.format(
+            ', '.join(store_columns), ', '.join('?' for _ in store_columns)), values)
+        conn.execute('INSERT INTO criteria_fts (rowid, source_sentence) SELECT id, source_sentence FROM criteria '
+                     'WHERE trial_id = ?', (trial_id,))
+
+    def _where(self, trial_id=None, type=None, entity=None, attribute=None, attribute_contains=None, value=None,
+               text=None):
+        conditions = []
+        params = []
+        if trial_id is not None:
+            conditions.append('c.trial_id = ?')
+            params.append(trial_id.upper())
+        for column, argument in (('type', type), ('entity', entity), ('value', value)):
+            if argument is not None:
+                # these columns are declared COLLATE NOCASE, so the comparison can use their indexes
+                conditions.append('c.{} = ?'.format(column))
+                params.append(argument)
+        if attribute is not None:
+            conditions.append('c.attribute_norm = ?')
+            params.append(normalize_attribute(attribute))
+        if attribute_contains is not None:
+            conditions.append('instr(c.attribute_norm, ?) > 0')
+            params.append(normalize_attribute(attribute_contains))
+        if text is not None:
+            conditions.append('c.id IN (SELECT rowid FROM criteria_fts WHERE criteria_fts MATCH ?)')
+            params.append(fts_query(text))
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+    def query(self, limit=None, **criteria):
+        # Every given criterion must match: attribute matches the normalized attribute exactly,
+        # attribute_contains as a substring; type, entity and value are case insensitive; text is
+        # a full-text search over the source sentence. Returns dicts keyed by output column name.
+        where, params = self._where(**criteria)
+        sql = 'SELECT c.* FROM criteria c' + where + ' ORDER BY c.trial_id, c.id'
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        with connect(self.db_path) as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [{name: row[column] for name, column in columns.items()} for row in rows]
+
+    def trial_ids(self, **criteria):
+        # IDs of the trials with at least one criterion matching the query() criteria
+        where, params = self._where(**criteria)
+        with connect(self.db_path) as conn:
+            rows = conn.execute('SELECT DISTINCT c.trial_id FROM criteria c' + where + ' ORDER BY c.trial_id', params)
+            return [row['trial_id'] for row in rows]
+
+    def __len__(self):
+        with connect(self.db_path) as conn:
+            return conn.execute('SELECT COUNT(DISTINCT trial_id) FROM criteria').fetchone()[0]
+
+
+def import_output_file(store, output_file_path):
+    # loads an existing -output_file (json lines or excel workbook with one sheet per trial) into the store
+    if output_file_path.endswith('.jsonl'):
+        by_trial = {}
+        with open(output_file_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    by_trial.setdefault(row['Trial ID'], []).append(row)
+    else:
+        import pandas as pd
+
+        sheets = pd.read_excel(output_file_path, sheet_name=None)
+        by_trial = {trial_id: df.to_dict('records') for trial_id, df in sheets.items()}
+    store.write_trials(by_trial.items())
+    return len(by_trial)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Query the store of extracted eligibility criteria.')
+    parser.add_argument('-store', '--criteria_store_file', required=True,
+                        help='SQLite criteria store written with eligibility_criteria_extraction.py -criteria_store')
+    parser.add_argument('-import_file', '--import_output_file', default=None,
+                        help='Load an existing output file (.jsonl or excel workbook) into the store first')
+    parser.add_argument('-trial_id', '--trial_id', default=None, help='Only criteria of this trial')
+    parser.add_argument('-type', '--criteria_type', default=None, help='Inclusion or Exclusion')
+    parser.add_argument('-entity', '--entity', default=None, help='Entity class, e.g. "Previous Treatment"')
+    parser.add_argument('-attribute', '--attribute', default=None,
+                        help='Attribute, matched after normalization (case, punctuation and numbering are ignored)')
+    parser.add_argument('-attribute_contains', '--attribute_contains', default=None,
+                        help='Substring of the normalized attribute, e.g. "pd 1"')
+    parser.add_argument('-value', '--value', default=None, help='Value, e.g. Yes, No or Allowed')
+    parser.add_argument('-text', '--sentence_text', default=None,
+                        help='Words that must all occur in the source sentence (full-text search)')
+    parser.add_argument('-trials_only', '--trials_only', action='store_true',
+                        help='Only print the IDs of the matching trials')
+    parser.add_argument('-limit', '--limit', type=int, default=None, help='Print at most this many criteria')
+    args = parser.parse_args()
+
+    store = CriteriaStore(args.criteria_store_file)
+    if args.import_output_file is not None:
+        print('Imported {} trials'.format(import_output_file(store, args.import_output_file)))
+
+    criteria = dict(trial_id=args.trial_id, type=args.criteria_type, entity=args.entity, attribute=args.attribute,
+                    attribute_contains=args.attribute_contains, value=args.value, text=args.sentence_text)
+    if args.trials_only:
+        for trial_id in store.trial_ids(**criteria):
+            print(trial_id)
+    elif any(v is not None for v in criteria.values()) or args.import_output_file is None:
+        for row in store.query(limit=args.limit, **criteria):
+            print(json.dumps(row))
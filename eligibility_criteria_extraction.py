@@ -1,27 +1,50 @@
-import os
-import json
-import pandas as pd
+import sys
 import re
-from tqdm import tqdm
 import logging
 import argparse
-from bs4 import BeautifulSoup
-import glob
-from nltk import word_tokenize
-from langchain.prompts.pipeline import PipelinePromptTemplate
-from langchain.prompts import PromptTemplate
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import LLMChain
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain.callbacks import StdOutCallbackHandler
-
-os.environ["OPENAI_API_KEY"] = "<insert_openai_api_key_here>"
+import itertools
+import functools
+from trial_scheduler import TokenBudget, TrialQueue, load_priority_spec, schedule_trials, read_trial_summary, order_trials
+from model_cascade import load_cascade
+from section_packer import SectionPacker, count_tokens, pack_sections, demultiplex
+from work_queue import WorkQueue, LeaseKeeper, default_worker_id
+from streaming_pipeline import Stage, run_pipeline
+from trial_discovery import discover_trials, load_manifest, parse_id_range
+from json_salvage import parse_json_objects, unprocessed_text
+from trial_index import TrialIndex, parse_where, where_matches, read_trial_fields
+from criteria_sections import segment_blocks, criteria_texts
+from criteria_store import CriteriaStore
+from chunk_dedup import ChunkIndex
 
 for handler in logging.root.handlers[:]:
     logging.root.removeHandler(handler)
 
+disease_text = " non-alcoholic steatohepatitis (NASH)"
+
+max_tokens = 2000
+num_retries = 3
+delay_time = 600
+chunk_size = 200
+# follow-up requests for the rest of a chunk when a response was cut off by the output limit
+max_continuations = 2
+
+# tokens spent by all llm calls in this run, checked by the scheduler between trials
+token_budget = TokenBudget()
+
+# routes each prompt type to a model; the OpenAI API key is read from the OPENAI_API_KEY environment variable (or -api_key)
+llm_cascade = load_cascade()
+
+# optional criteria_store.CriteriaStore that every written trial is also added to (-criteria_store)
+criteria_store = None
+
+# optional chunk_dedup.ChunkIndex of extracted chunks, reused for near-duplicate chunks (-chunk_index)
+chunk_index = None
+
 
 def generate_time_frame_prompt(sentence_text, attribute_text):
+    from langchain.prompts.pipeline import PipelinePromptTemplate
+    from langchain.prompts import PromptTemplate
+
     full_template = """
         {general_instruction}
 
@@ -52,6 +75,9 @@ def generate_time_frame_prompt(sentence_text, attribute_text):
 
 
 def generate_individual_diseases_prompt(sentence_text):
+    from langchain.prompts.pipeline import PipelinePromptTemplate
+    from langchain.prompts import PromptTemplate
+
     full_template = """
         {general_instruction}
 
@@ -82,6 +108,9 @@ def generate_individual_diseases_prompt(sentence_text):
 
 
 def generate_individual_treatments_prompt(sentence_text):
+    from langchain.prompts.pipeline import PipelinePromptTemplate
+    from langchain.prompts import PromptTemplate
+
     full_template = """
         {general_instruction}
 
@@ -111,7 +140,11 @@ def generate_individual_treatments_prompt(sentence_text):
     return individual_diseases_prompt
 
 
-def generate_inclusion_criteria_prompt(criteria_text_inclusion):
+def generate_inclusion_criteria_prompt(criteria_text_inclusion, packed=False):
+    from langchain.prompts.pipeline import PipelinePromptTemplate
+    from langchain.prompts import PromptTemplate
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+
     full_template = """
         {general_instruction}
 
@@ -133,6 +166,9 @@ def generate_inclusion_criteria_prompt(criteria_text_inclusion):
     general_instruction_prompt = PromptTemplate.from_template(general_instruction_template)
 
     inclusion_criteria_text_template = """[Inclusion Criteria Text]:\n\n""" + criteria_text_inclusion + """\n\n"""
+    if packed:
+        # criteria sections of several trials, each starting with a [Trial <trial ID>] tag (see section_packer.py)
+        inclusion_criteria_text_template += """The above text contains the inclusion criteria of several trials. The criteria of each trial start with a [Trial <trial ID>] tag. Extract the criteria of every trial separately, never combine criteria from different trials, and in addition to the other fields put the trial ID from the tag under a "Trial ID" field.\n\n"""
     inclusion_criteria_text_prompt = PromptTemplate.from_template(inclusion_criteria_text_template)
 
     criteria_of_interest_template = """
@@ -159,11 +195,19 @@ def generate_inclusion_criteria_prompt(criteria_text_inclusion):
         ResponseSchema(name="Sentence",
                        description="the corresponding sentence or phrase in the text where an eligibility criteria was found")
     ]
+    if packed:
+        response_schemas.append(ResponseSchema(name="Trial ID",
+                                               description="the trial ID from the [Trial <trial ID>] tag of the section where an eligibility criteria was found"))
     output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
     format_instructions = output_parser.get_format_instructions()
+    # a packed request asks for the trial ID as a sixth field, which demultiplexing depends on
+    if packed:
+        field_keys = '6 fields with keys Entity, Attribute, Value, Condition, Sentence, and Trial ID'
+    else:
+        field_keys = '5 fields with keys Entity, Attribute, Value, Condition, and Sentence'
 
     output_format_template = """
-    Show everything in 5 fields with keys Entity, Attribute, Value, Condition, and Sentence.\n{format_instructions}\n' \
+    Show everything in {field_keys}.\n{format_instructions}\n' \
     'Include any other condition/restriction/exception, other details, or specific conditions for specific patient groups ' \
     'under the "Condition" field of each treatment or therapy, medication, biomarker, lab test, and disease. ' \
     'Please think deeply to extract this information. ' \
@@ -175,7 +219,9 @@ def generate_inclusion_criteria_prompt(criteria_text_inclusion):
     'Only show the lab test names that are mentioned. In case only adequate organ function is mentioned, specify that as a different entity under "Attribute" field.' \
     'Also create different lab test entities when the conditions are different (e.g., varying disease conditions).\n
     """
-    output_format_prompt = PromptTemplate.from_template(output_format_template, partial_variables={"format_instructions": format_instructions})
+    output_format_prompt = PromptTemplate.from_template(output_format_template,
+                                                        partial_variables={"format_instructions": format_instructions,
+                                                                           "field_keys": field_keys})
 
     criteria_level_instructions_template = """
     For Biomarkers, put all gene, gene product names, and imaging or fibrosis biomarkers (including Min_liver_fat MRI-PDFF and fibrosis stage) under "Attribute" field, and their mutation types or expression level or value under "Value" field ' \
@@ -232,7 +278,11 @@ def generate_inclusion_criteria_prompt(criteria_text_inclusion):
 
 
 
-def generate_exclusion_criteria_prompt(criteria_text_exclusion):
+def generate_exclusion_criteria_prompt(criteria_text_exclusion, packed=False):
+    from langchain.prompts.pipeline import PipelinePromptTemplate
+    from langchain.prompts import PromptTemplate
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+
     full_template = """
         {general_instruction}
 
@@ -254,6 +304,9 @@ def generate_exclusion_criteria_prompt(criteria_text_exclusion):
     general_instruction_prompt = PromptTemplate.from_template(general_instruction_template)
 
     exclusion_criteria_text_template = """[Exclusion Criteria Text]:\n\n""" + criteria_text_exclusion + """\n\n"""
+    if packed:
+        # criteria sections of several trials, each starting with a [Trial <trial ID>] tag (see section_packer.py)
+        exclusion_criteria_text_template += """The above text contains the exclusion criteria of several trials. The criteria of each trial start with a [Trial <trial ID>] tag. Extract the criteria of every trial separately, never combine criteria from different trials, and in addition to the other fields put the trial ID from the tag under a "Trial ID" field.\n\n"""
     exclusion_criteria_text_prompt = PromptTemplate.from_template(exclusion_criteria_text_template)
 
     criteria_of_interest_template = """
@@ -280,11 +333,18 @@ def generate_exclusion_criteria_prompt(criteria_text_exclusion):
         ResponseSchema(name="Sentence",
                        description="the corresponding sentence or phrase in the text where an eligibility criteria was found")
     ]
+    if packed:
+        response_schemas.append(ResponseSchema(name="Trial ID",
+                                               description="the trial ID from the [Trial <trial ID>] tag of the section where an eligibility criteria was found"))
     output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
     format_instructions = output_parser.get_format_instructions()
+    if packed:
+        field_keys = '6 fields with keys Entity, Attribute, Value, Condition, Sentence, and Trial ID'
+    else:
+        field_keys = '5 fields with keys Entity, Attribute, Value, Condition, and Sentence'
 
     output_format_template = """
-    Show everything in 5 fields with keys Entity, Attribute, Value, Condition, and Sentence.\n{format_instructions}\n' \
+    Show everything in {field_keys}.\n{format_instructions}\n' \
                               'Include any condition/restriction/exception, other details, or specific conditions for specific patient groups ' \
                               'under the "Condition" field of each treatment, biomarker, disease, procedure, and medication. ' \
                               'Please think deeply to extract this information. ' \
@@ -292,7 +352,9 @@ def generate_exclusion_criteria_prompt(criteria_text_exclusion):
                               'The phrase under "Attribute" field must be present in the phrase under "Sentence" field. ' \
                               'The "Condition" should show temporal/condition information very precisely.\n
     """
-    output_format_prompt = PromptTemplate.from_template(output_format_template, partial_variables={"format_instructions": format_instructions})
+    output_format_prompt = PromptTemplate.from_template(output_format_template,
+                                                        partial_variables={"format_instructions": format_instructions,
+                                                                           "field_keys": field_keys})
 
     criteria_level_instructions_template = """
     For Biomarkers, put all gene, gene product names, and receptor names under "Attribute" field, and their mutation types or expression level or value under "Value" field ' \
@@ -342,16 +404,19 @@ def generate_exclusion_criteria_prompt(criteria_text_exclusion):
 
 
 def generate_prompts(criteria_text_ex, criteria_text_in):
+    # trials with only one of the two sections only get a prompt for that section
     prompts = {}
-    prompt_in, o_p_in = generate_inclusion_criteria_prompt(criteria_text_in)
-    prompt_ex, o_p_ex = generate_exclusion_criteria_prompt(criteria_text_ex)
-
-    prompts['in'] = {'prompt': prompt_in, 'criteria_text': criteria_text_in, 'output_parser': o_p_in}
-    prompts['ex'] = {'prompt': prompt_ex, 'criteria_text': criteria_text_ex, 'output_parser': o_p_ex}
+    if criteria_text_in is not None:
+        prompt_in, o_p_in = generate_inclusion_criteria_prompt(criteria_text_in)
+        prompts['in'] = {'prompt': prompt_in, 'criteria_text': criteria_text_in, 'output_parser': o_p_in}
+    if criteria_text_ex is not None:
+        prompt_ex, o_p_ex = generate_exclusion_criteria_prompt(criteria_text_ex)
+        prompts['ex'] = {'prompt': prompt_ex, 'criteria_text': criteria_text_ex, 'output_parser': o_p_ex}
     return prompts
 
 
 def process(message, df_output, type, trial_ID, no_retries, d_time, max_toks, phase_str, lnk_str, cri_text_sent):
+    import pandas as pd
  
     for extracted_criteria in message:
         entity = extracted_criteria['Entity'].strip()
@@ -486,7 +551,8 @@ def process(message, df_output, type, trial_ID, no_retries, d_time, max_toks, ph
 
             o_p = None
 
-            time_frame_response = generate_response_for_partial_doc(prompt_time_frame, o_p, no_retries, d_time, max_toks, trial_ID, type)
+            time_frame_response = generate_response_for_partial_doc(prompt_time_frame, o_p, no_retries, d_time, max_toks, trial_ID, type,
+                                                                    prompt_type='time_frame', source_text=sentence)
             # print('Time frame response: \n')
             # print(time_frame_response)
             
@@ -507,7 +573,8 @@ def process(message, df_output, type, trial_ID, no_retries, d_time, max_toks, ph
             original_com_attribute = attribute.strip()
 
             o_p = None
-            diseases_response = generate_response_for_partial_doc(prompt_for_individual_diseases, o_p, no_retries, d_time, max_toks, trial_ID, type)
+            diseases_response = generate_response_for_partial_doc(prompt_for_individual_diseases, o_p, no_retries, d_time, max_toks, trial_ID, type,
+                                                                  prompt_type='diseases', source_text=sentence)
 
             # print('Diseases response: \n')
             # print(diseases_response)
@@ -561,7 +628,8 @@ def process(message, df_output, type, trial_ID, no_retries, d_time, max_toks, ph
             original_tr_attribute = attribute.strip()
 
             o_p = None
-            treatment_response = generate_response_for_partial_doc(prompt_for_individual_treatments, o_p, no_retries, d_time, max_toks, trial_ID, type)
+            treatment_response = generate_response_for_partial_doc(prompt_for_individual_treatments, o_p, no_retries, d_time, max_toks, trial_ID, type,
+                                                                   prompt_type='treatments', source_text=sentence)
             # print('Treatment response: \n')
             # print(treatment_response)
             
@@ -598,18 +666,17 @@ def generate_response(prompt, n_retry, delay, max_tokens, tr_id, cri_type):
         cri_type = 'Inclusion'
     else:
         cri_type = 'Exclusion'
+    prompt_type = cri_type.lower()
     for i in range(n_retry):
         try:
-            llm = ChatOpenAI(model_name="gpt-4", temperature=0)
-            chain = LLMChain(llm=llm, prompt=prompt['prompt'])
+            prompt_text = prompt['prompt'].format(disease=disease_text)
             # printing the prompt text
-            # handler = StdOutCallbackHandler()
-            # chain = LLMChain(llm=llm, prompt=prompt['prompt'], callbacks=[handler])
-            output = chain.run({"disease": " non-alcoholic steatohepatitis (NASH)"})
+            # print(prompt_text)
+            output, total_tokens = llm_cascade.complete(prompt_text, prompt_type, prompt['criteria_text'])
+            token_budget.add(total_tokens)
             out_parser = prompt['output_parser']
             # output = out_parser.parse(output)
-            json_strings = output.split("```json\n")[1:]
-            list_of_dicts = [json.loads(s.split("\n```")[0]) for s in json_strings]
+            list_of_dicts, _ = parse_criteria_response(output, prompt_type, prompt['criteria_text'], tr_id)
 
             # print("JSON Output: \n")
             # print(list_of_dicts)
@@ -621,24 +688,29 @@ def generate_response(prompt, n_retry, delay, max_tokens, tr_id, cri_type):
                   '{} retries'.format(tr_id, cri_type, str(n_retry)))
 
 
-def generate_response_for_partial_doc(prompt, output_p, n_retry, delay, max_tokens, tr_id, cri_type):
+def generate_response_for_partial_doc(prompt, output_p, n_retry, delay, max_tokens, tr_id, cri_type, prompt_type=None, source_text=None,
+                                      packed=False):
+    # a packed request returns (criteria, truncated), see extract_packed_criteria()
     if cri_type == 'in':
         cri_type = 'Inclusion'
     else:
         cri_type = 'Exclusion'
+    if prompt_type is None:
+        prompt_type = cri_type.lower()
     for i in range(n_retry):
         try:
-            llm = ChatOpenAI(model_name="gpt-4", temperature=0)
-            chain = LLMChain(llm=llm, prompt=prompt)
+            prompt_text = prompt.format(disease=disease_text)
             # printing the prompt text
-            # handler = StdOutCallbackHandler()
-            # chain = LLMChain(llm=llm, prompt=prompt, callbacks=[handler])
+            # print(prompt_text)
 
-            output = chain.run({"disease": " non-alcoholic steatohepatitis (NASH)"})
+            output, total_tokens = llm_cascade.complete(prompt_text, prompt_type, source_text)
+            token_budget.add(total_tokens)
             if output_p is not None:
                 # output = output_p.parse(output)
-                json_strings = output.split("```json\n")[1:]
-                output = [json.loads(s.split("\n```")[0]) for s in json_strings]
+                # a continuation of a packed request would lose the [Trial <trial ID>] tags, so only salvage
+                output, truncated = parse_criteria_response(output, prompt_type, None if packed else source_text, tr_id)
+                if packed:
+                    return output, truncated
 
             # print("JSON Output: \n")
             # print(output)
@@ -651,6 +723,43 @@ def generate_response_for_partial_doc(prompt, output_p, n_retry, delay, max_toke
         
 
 
+def parse_criteria_response(output, prompt_type, source_text, tr_id, continuations=None):
+    # Keeps every well-formed criteria object of the response. When the response was cut off, only the
+    # sentences after the last extracted one are sent in a continuation request instead of repeating the
+    # whole request; a response without any usable object raises so that the caller retries it.
+    # Returns (criteria, truncated), truncated when part of the source text may still be unextracted.
+    if continuations is None:
+        continuations = max_continuations
+    list_of_dicts, truncated = parse_json_objects(output)
+    if not truncated:
+        return list_of_dicts, False
+    if len(list_of_dicts) == 0:
+        raise ValueError('Response does not contain any well-formed criteria')
+
+    remaining_text = unprocessed_text(source_text, list_of_dicts) if source_text is not None else None
+    if remaining_text is None or continuations == 0:
+        logging.warning('Trial ID: {} -- Criteria: {} -- Response was cut off, keeping {} complete '
+                        'criteria'.format(tr_id, prompt_type, len(list_of_dicts)))
+        return list_of_dicts, True
+
+    logging.info('Trial ID: {} -- Criteria: {} -- Response was cut off after {} criteria, continuing with the '
+                 'remaining {} characters'.format(tr_id, prompt_type, len(list_of_dicts), len(remaining_text)))
+    try:
+        if prompt_type == 'inclusion':
+            continuation_prompt, _ = generate_inclusion_criteria_prompt(remaining_text)
+        else:
+            continuation_prompt, _ = generate_exclusion_criteria_prompt(remaining_text)
+        output, total_tokens = llm_cascade.complete(continuation_prompt.format(disease=disease_text), prompt_type,
+                                                    remaining_text)
+        token_budget.add(total_tokens)
+        continued, truncated = parse_criteria_response(output, prompt_type, remaining_text, tr_id, continuations - 1)
+        return list_of_dicts + continued, truncated
+    except Exception as e:
+        logging.error('Trial ID: {} -- Criteria: {} -- ERROR: Continuation request failed, keeping {} complete '
+                      'criteria: {}'.format(tr_id, prompt_type, len(list_of_dicts), str(e)))
+        return list_of_dicts, True
+
+
 def divide_document(text):
     # Split the text into sentences
     sentences = text.split('. ')
@@ -688,307 +797,773 @@ def process_half_text_response(half_text_response, df_half_output, cri_type, ph_
                        )
 
 
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser(description='Running GPT on clinical trial documents to extract eligibility criteria.')
-    parser.add_argument('-input_file', '--input_xml_file', help='File path to the directory of xml files containing raw clinical trial data')
-    parser.add_argument('-output_file', '--output_file_extracted_entities',
-                        help='File path to an excel file storing all extracted criteria with each sheet containing criteria for a trial document')
-    parser.add_argument('-log_file', '--log_file_path',
-                        help='File path to log file containing all information, warning and error messages')
-
-    args = parser.parse_args()
-
-    log_file_path = args.log_file_path
-    input_file_path = args.input_xml_file
+def read_trial(filename):
+    from bs4 import BeautifulSoup
+
+    with open(filename, 'r') as f:
+        trial_data = f.read()
+    trial_data = BeautifulSoup(trial_data, "xml")
+
+    trial_id = trial_data.find('nct_id').text
+    trial_id = str(trial_id)
+
+    min_age_str = None
+    max_age_str = None
+    gender_str = None
+    if trial_data.find('minimum_age'):
+        min_age_str = trial_data.find('minimum_age').text
+    if trial_data.find('maximum_age'):
+        max_age_str = trial_data.find('maximum_age').text
+    if trial_data.find('gender'):
+        gender_str = trial_data.find('gender').text
+
+    # the criteria text blocks of all <eligibility> elements, split into inclusion/exclusion sections
+    criteria_blocks = []
+    for eligibility in trial_data.find_all('eligibility'):
+        criteria = eligibility.find('criteria')
+        if criteria is not None and criteria.find('textblock') is not None:
+            criteria_blocks.append(criteria.find('textblock').text)
+    in_criteria_text, ex_criteria_text = criteria_texts(segment_blocks(criteria_blocks))
+
+    if in_criteria_text is None and ex_criteria_text is None:
+        logging.warning('Trial ID: {} -- Both inclusion and exclusion criteria text are null.'.format(trial_id))
+        return None
+    if in_criteria_text is None or ex_criteria_text is None:
+        logging.warning('Trial ID: {} -- Only the {} criteria text was found.'.format(
+            trial_id, 'inclusion' if ex_criteria_text is None else 'exclusion'))
+
+    phase_str = trial_data.find('phase').text
+
+    if '/' in phase_str:
+        f_p = phase_str.split('/')[0]
+        s_p = phase_str.split('/')[1]
+        f_p = f_p.lower().split('phase')[1].strip()
+        s_p = s_p.lower().split('phase')[1].strip()
+        phase_str = f_p + '/' + s_p
+    else:
+        phase_str = phase_str.lower().split('phase')[1].strip()
+
+    url_str = trial_data.find('url').text
+
+    return {'trial_id': trial_id, 'phase': phase_str, 'url': url_str, 'min_age': min_age_str, 'max_age': max_age_str,
+            'gender': gender_str, 'in_criteria_text': in_criteria_text, 'ex_criteria_text': ex_criteria_text}
+
+
+def find_trial_files(input_dir, manifest_ids=None, id_range=None, where_clauses=None, trial_index=None):
+    # With a trial index the -where selection is a query on the sidecar; without one the structured
+    # fields of each discovered file are read with a regex scan, so non-matching trials are skipped
+    # before the full parse and before any prompt is sent.
+    if where_clauses is not None and trial_index is not None:
+        if len(trial_index) == 0:
+            if input_dir is None:
+                logging.warning('Trial index {} is empty, no trials selected (build it with -input_file and '
+                                '-build_index)'.format(trial_index.db_path))
+                return
+            logging.warning('Trial index {} is empty, building it from {}'.format(trial_index.db_path, input_dir))
+            trial_index.build(discover_trials(input_dir))
+        for trial_id, filename in trial_index.select(where_clauses, input_dir):
+            if manifest_ids is not None and trial_id not in manifest_ids:
+                continue
+            if id_range is not None and not id_range[0] <= trial_id <= id_range[1]:
+                continue
+            yield filename
+        return
+    for filename in discover_trials(input_dir, manifest_ids, id_range):
+        if where_clauses is None or where_matches(where_clauses, read_trial_fields(filename)):
+            yield filename
+
+
+def new_trial_output():
+    import pandas as pd
+
+    return pd.DataFrame(columns=['Trial ID', 'Type', 'Phase', 'URL', 'Entity',
+                                 'Attribute', 'Value', 'Temporal', 'Modifier', 'Source Sentence'
+                                 ])
+
+
+def chunk_criteria_text(criteria_text, chunk_size):
+    from nltk import word_tokenize
+
+    # Dividing the criteria text into chunks preserving sentence boundaries
+    chunks = []
+    chunk = ''
+    words = 0
+    # for sentence in re.split(r'(\. |\? |\! |\n)', criteria_text):
+    for sentence in re.split(r'(\. |\? )', criteria_text):
+        # print('Sentence: \n')
+        # print(sentence)
+        if len(sentence.strip()) > 0:
+            sentence_words = len(word_tokenize(sentence))
+            if words + sentence_words <= chunk_size:
+                chunk += sentence + ' '
+                words += sentence_words
+            else:
+                chunks.append(chunk)
+                chunk = sentence + ' '
+                words = sentence_words
+    if len(chunk) > 0:
+        chunks.append(chunk)
 
-    max_tokens = 2000
-    num_retries = 3
-    delay_time = 600
-    chunk_size = 200
+    # Chunks that only contain a one or two-digit number followed by a period.
+    pattern = r"^\d{1,2}\.$"
+    return [chunk for chunk in chunks if not re.match(pattern, chunk)]
 
-    trial_index = 0
 
-    output_file_path = args.output_file_extracted_entities
-    logging.basicConfig(level=logging.INFO, filename=log_file_path,
-                        format='%(asctime)s [%(levelname)s] %(message)s',
-                        datefmt='%a, %d %b %Y %H:%M:%S')
+def generate_chunk_response(item, chunk, trial_id, num_retries, delay_time, max_tokens):
+    if item == 'in':
+        reduced_prompt_chunk, o_p = generate_inclusion_criteria_prompt(chunk)
+    else:
+        reduced_prompt_chunk, o_p = generate_exclusion_criteria_prompt(chunk)
+
+    return generate_response_for_partial_doc(reduced_prompt_chunk, o_p, num_retries, delay_time, max_tokens, trial_id,
+                                             item, source_text=chunk)
+
+
+def generate_chunk_response_with_reuse(item, chunk, trial_id, num_retries, delay_time, max_tokens):
+    # When the chunk index has a near-duplicate of the chunk (e.g. a sponsor template with different
+    # numbering or one drug name changed), the criteria of the unchanged lines are reused and only
+    # the changed lines are sent for extraction.
+    reused, fresh_units, similarity = chunk_index.lookup(item, chunk)
+    if similarity is None:
+        response = generate_chunk_response(item, chunk, trial_id, num_retries, delay_time, max_tokens)
+        if response is not None:
+            chunk_index.add(item, chunk, response)
+        return response
+
+    logging.info('Trial ID: {} -- Criteria: {} -- Near-duplicate chunk ({:.2f} similar), reusing {} criteria, '
+                 'extracting {} changed lines'.format(trial_id, item, similarity, len(reused), len(fresh_units)))
+    if len(fresh_units) == 0:
+        return reused
+    response = generate_chunk_response(item, '\n'.join(fresh_units), trial_id, num_retries, delay_time, max_tokens)
+    if response is None:
+        return None
+    # this variant is indexed too, so that later chunks can match it directly
+    chunk_index.add(item, chunk, reused + response)
+    return reused + response
+
+
+def extract_criteria_chunk(item, chunk, trial, df_write, num_retries, delay_time, max_tokens):
+    trial_id = trial['trial_id']
+
+    # print('Chunk:\n')
+    # print(chunk)
+    if chunk_index is not None:
+        response_text_chunk = generate_chunk_response_with_reuse(item, chunk, trial_id, num_retries, delay_time,
+                                                                 max_tokens)
+    else:
+        response_text_chunk = generate_chunk_response(item, chunk, trial_id, num_retries, delay_time, max_tokens)
+    # print("Response: \n")
+    # print(response_text_chunk)
+    return process_half_text_response(response_text_chunk, df_write, item, trial['phase'], trial['url'],
+                                      trial_id, num_retries, delay_time, max_tokens, chunk)
 
-    files = glob.glob(f'{input_file_path}/*.xml')
-    # files = files[0:1]
-    for filename in tqdm(files):
-        with open(filename, 'r') as f:
-            trial_data = f.read()
 
-            df_write = pd.DataFrame(columns=['Trial ID', 'Type', 'Phase', 'URL', 'Entity',
-                                             'Attribute', 'Value', 'Temporal', 'Modifier', 'Source Sentence'
-                                             ])
-            trial_data = BeautifulSoup(trial_data, "xml")
+def extract_criteria(item, prompt, trial, df_write, num_retries, delay_time, max_tokens, chunk_size):
+    from nltk import word_tokenize
 
-            trial_id = trial_data.find('nct_id').text
-            trial_id = str(trial_id)
-            ex_criteria_text = None
-            in_criteria_text = None
+    trial_id = trial['trial_id']
+    phase_str = trial['phase']
+    url_str = trial['url']
 
-            seq_num = int(trial_index) + 1
-            logging.info('Processing sequence number: {}, with trial ID: {}\n'.format(seq_num, trial_id))
+    criteria_text_length = len(word_tokenize(prompt['criteria_text']))
+    if criteria_text_length <= chunk_size:
+        print('Criteria text: {} of trial ID {} contains less than {} words'.format(item, trial_id, chunk_size))
 
-            min_age_str = None
-            max_age_str = None
-            gender_str = None
-            if trial_data.find('minimum_age'):
-                min_age_str = trial_data.find('minimum_age').text
-            if trial_data.find('maximum_age'):
-                max_age_str = trial_data.find('maximum_age').text
-            if trial_data.find('gender'):
-                gender_str = trial_data.find('gender').text
-
-            all_eligibility = trial_data.find_all('eligibility')
-            for eligibility in all_eligibility:
-                criteria = eligibility.find('criteria')
-                criteria_text_block = criteria.find('textblock').text
-
-                
-                if 'inclusion criteria' in criteria_text_block.lower() and 'exclusion criteria' in criteria_text_block.lower():
-                    splits_by_inclusion = re.split('Inclusion Criteria|Inclusion criteria|inclusion criteria|inclusion Criteria|INCLUSION CRITERIA', criteria_text_block, 1)
-                    text_following_inclusion = splits_by_inclusion[1]
-                    splits_by_exclusion = re.split('Exclusion Criteria|Exclusion criteria|exclusion criteria|exclusion Criteria|EXCLUSION CRITERIA',
-                                                   text_following_inclusion, 1)
-                    in_criteria_text = splits_by_exclusion[0].strip()
-
-                    # print('''===Inclusion===\n''')
-                    # print(in_criteria_text)
-
-                    ex_criteria_text = splits_by_exclusion[1].strip()
-                    # print('''===Exclusion===''')
-                    # print(ex_criteria_text)
-
-            if in_criteria_text is None and ex_criteria_text is None:
-                logging.warning('Trial ID: {} -- Either inclusion or exclusion criteria text is null.'.format(trial_id))
-                continue
+        response_text = generate_response(prompt, num_retries, delay_time, max_tokens, trial_id, item)
 
-            phase_str = trial_data.find('phase').text
+        if response_text == 'INPUT TOO LONG':
+            # split criteria text into halves
+            if item == 'in':
+                first, second = divide_document(prompt['criteria_text'])
+                reduced_prompt_first_half, o_p_first = generate_inclusion_criteria_prompt(first)
+                reduced_prompt_second_half, o_p_second = generate_inclusion_criteria_prompt(second)
 
-            if '/' in phase_str:
-                f_p = phase_str.split('/')[0]
-                s_p = phase_str.split('/')[1]
-                f_p = f_p.lower().split('phase')[1].strip()
-                s_p = s_p.lower().split('phase')[1].strip()
-                phase_str = f_p + '/' + s_p
             else:
-                phase_str = phase_str.lower().split('phase')[1].strip()
+                first, second = divide_document(prompt['criteria_text'])
+
+                reduced_prompt_first_half, o_p_first = generate_exclusion_criteria_prompt(first)
+                reduced_prompt_second_half, o_p_second = generate_exclusion_criteria_prompt(second)
+
+
+            response_text_first = generate_response_for_partial_doc(reduced_prompt_first_half, o_p_first, num_retries,
+                                                                    delay_time, max_tokens, trial_id, item,
+                                                                    source_text=first)
+            response_text_second = generate_response_for_partial_doc(reduced_prompt_second_half, o_p_second,
+                                                                     num_retries, delay_time, max_tokens,
+                                                                     trial_id, item, source_text=second)
+            df_write = process_half_text_response(response_text_first, df_write, item, phase_str, url_str,
+                                                  trial_id, num_retries, delay_time, max_tokens, prompt['criteria_text'])
+            df_write = process_half_text_response(response_text_second, df_write, item, phase_str, url_str,
+                                                  trial_id, num_retries, delay_time, max_tokens, prompt['criteria_text'])
+
+        elif response_text is not None:
+            if item == 'in':
+                df_write = process(response_text, df_write, 'Inclusion', trial_id, num_retries, delay_time,
+                                   max_tokens, phase_str, url_str, prompt['criteria_text'])
+            else:
+                df_write = process(response_text, df_write, 'Exclusion', trial_id, num_retries, delay_time,
+                                   max_tokens, phase_str, url_str, prompt['criteria_text'])
+    else:
+        print('Criteria text: {} of trial ID {} contains more than {} words'.format(item, trial_id, chunk_size))
+
+        for chunk in chunk_criteria_text(prompt['criteria_text'], chunk_size):
+            df_write = extract_criteria_chunk(item, chunk, trial, df_write, num_retries, delay_time, max_tokens)
+
+    return df_write
+
+
+def finalize_trial_output(df_write, trial):
+    import pandas as pd
+
+    trial_id = trial['trial_id']
+    phase_str = trial['phase']
+    url_str = trial['url']
+    min_age_str = trial['min_age']
+    max_age_str = trial['max_age']
+    gender_str = trial['gender']
+
+    df_write['Attribute'] = df_write['Attribute'].str.replace(r'(^(-|\s-))', '', regex=True)
+    df_write['Attribute'] = df_write['Attribute'].str.replace(r'(^(?:[1-9]|[1-9][0-9]|100)\. ?)', '', regex=True)
+    df_write['Attribute'] = df_write['Attribute'].str.strip()
+    df_write['Attribute_Lowercase'] = df_write['Attribute'].str.lower()
+
+
+    def is_substring(row):
+        text = row['Attribute'].lower()
+        for other_text in df_write['Attribute'].str.lower():
+            # here we apply the length of text constraint to avoid removing short attributes such as ast and alt which can occur as a substring in other attribute phrases
+            if text in other_text and text != other_text and len(text) > 4:
+                return True
+        return False
+
+
+    # to select the longest overlapping attribute phrase
+    df_write = df_write[~df_write.apply(is_substring, axis=1)]
+
+    # dropping duplicate attribute phrases for Comorbidity, Lab Test, and Treatment History entities
+    df_write_com_lab = df_write[df_write['Entity'].isin(['Comorbidity', 'Lab Test', 'Treatment History'])].copy()
+    df_write_com_lab_dedup = df_write_com_lab.drop_duplicates(subset=['Attribute_Lowercase'], keep='first')
+    df_write_others = df_write[~df_write['Entity'].isin(['Comorbidity', 'Lab Test', 'Treatment History'])].copy()
+    component_dfs = [df_write_com_lab_dedup, df_write_others]
+    df_write_com_lab_dedup_plus_others_all = pd.concat(component_dfs)
+    df_write = df_write_com_lab_dedup_plus_others_all.drop(columns=['Attribute_Lowercase'])
+
+
+    for i in range(len(df_write)):
+        row = df_write.iloc[i]
+
+        # adding in-situ to allowed excepted cancers
+        # can make it more restrictive
+        cancer_related_words = ['cancer', 'carcinoma', 'dysplasia']
+        # if row['Entity'].lower().strip() == 'comorbidity' and any(c in row['Attribute'].lower().strip() for c in
+        #                                                          cancer_related_words) and row['Value'].lower().strip() == 'allowed':
+        # rule for excepted cancers
+        if row['Entity'].lower().strip() == 'comorbidity' and any(c in row['Attribute'].lower().strip() for c in cancer_related_words) and 'meningitis' not in row['Attribute'].lower():
+            corresponding_sent = row['Source Sentence'].lower().strip()
+            original_attr = row['Attribute'].strip()
+            for word in ['except', 'excluding', 'permitted', 'allowed', 'still eligible', 'may be eligible']:
+                if word in corresponding_sent:
+                    index = corresponding_sent.index(word) + len(word) + 1  # index of the word after the matched word
+                    if any(c in corresponding_sent[index:] for c in cancer_related_words):
+                        row['Attribute'] = original_attr + ', (in-situ)'
+                        row['Value'] = 'Allowed'
+                        break
+
+    # remove "Prior LOT" attributes, any attribute phrase containing "Any", and any attribute containing none-like values
+    df_write = df_write[~df_write['Attribute'].isin(['Prior LOT', 'Any'])]
+    search_for_none_values = ['none', 'n/a', 'not mentioned', 'not specified', 'not available', 'not found', 'not applicable']
+    df_write = df_write[~df_write['Attribute'].str.contains('|'.join(search_for_none_values), case=False)]
+
+
+    df_write = df_write[
+        ~df_write['Attribute'].str.lower().isin(
+            ['no diseases are mentioned in this sentence.', 'no diseases mentioned in this sentence.',
+             'no specific diseases mentioned', 'no specific diseases are mentioned',
+             'there are no diseases mentioned in this sentence.',
+             'there are no specific diseases mentioned in this sentence.',
+             'there are no specific treatment names, therapy names, medication or drug names, or procedure names mentioned in this sentence.',
+             'there are no treatment names, therapy names, medication or drug names, or procedure names mentioned in this sentence.',
+             'there are no specific disease or health condition terms mentioned in this sentence.',
+             'there are no disease or health condition terms mentioned in this sentence.',
+             'there are no disease, health condition, or comorbidity terms mentioned in this sentence.',
+             'there are no disease or health condition terms mentioned in the given sentence.'])]
+
+
+    df_write = df_write[
+        ~df_write['Attribute'].str.lower().isin(
+            ['other disease', 'other diseases', 'procedure', 'procedures', 'comorbidity', 'comorbidities',
+             'medication', 'medications',
+             'contraception-related criteria', 'treatments or therapies', 'treatment or therapy', 'treatments',
+             'therapies', 'drugs', 'treatment', 'therapy', 'drug', 'contraception', 'diagnosis', 'diagnoses',
+             'other diseases or comorbidities', 'other disease or comorbidity', 'prior therapy',
+             'prior treatment', 'prior therapies', 'prior treatments', 'gene', 'gene product', 'receptor',
+             'hormone receptor', 'imaging biomarker',
+             'genes', 'gene products', 'receptors', 'hormone receptors', 'imaging biomarkers', 'imaging scan',
+             'imaging scans', 'complication', 'complications', 'issues', 'issue',
+             'side effects', 'syndromes', 'adverse events', 'side effect', 'syndrome', 'adverse event',
+             'mental issue', 'mental issues', 'allergy', 'disorder', 'symptoms', 'abnormalities', 'symptom', 'disorders'])]
+
+    # Populating available values for age and gender
+    if min_age_str is not None and max_age_str is not None:
+        age_str = '>=' + min_age_str + ' and ' + '<=' + max_age_str
+        df_write.loc[df_write['Attribute'] == 'Age', 'Value'] = age_str
+    elif min_age_str is None and max_age_str is not None:
+        age_str = '<=' + max_age_str
+        df_write.loc[df_write['Attribute'] == 'Age', 'Value'] = age_str
+    elif min_age_str is not None and max_age_str is None:
+        age_str = '>=' + min_age_str
+    else:
+        age_str = 'NA'
+
+    if gender_str is None:
+        gender_str = 'NA'
+
+    if not df_write['Attribute'].isin(['Age']).any():
+        new_df = pd.DataFrame(
+            {'Trial ID': [trial_id], 'Type': ['Inclusion'], 'Phase': [phase_str], 'URL': [url_str],
+             'Entity': ['Demographic'],
+             'Attribute': ['Age'], 'Value': [age_str], 'Temporal': ['NA'],
+             'Modifier': ['NA'], 'Source Sentence': ['Extracted from structured field.']})
+        df_write = pd.concat([df_write, new_df], ignore_index=True)
+    else:
+        missing_values = ['na', 'n/a', 'not available', 'none', 'not specified', 'not found', '-', '']
+        age_rows = df_write[df_write['Attribute'] == 'Age']
+        if not age_rows.empty and age_rows['Value'].isin(missing_values).any():
+            df_write.loc[df_write['Attribute'] == 'Age', 'Value'] = age_str
+
+    if not df_write['Attribute'].isin(['Gender']).any():
+        new_df = pd.DataFrame(
+            {'Trial ID': [trial_id], 'Type': ['Inclusion'], 'Phase': [phase_str], 'URL': [url_str],
+             'Entity': ['Demographic'],
+             'Attribute': ['Gender'], 'Value': [gender_str], 'Temporal': ['NA'],
+             'Modifier': ['NA'], 'Source Sentence': ['Extracted from structured field.']})
+        df_write = pd.concat([df_write, new_df], ignore_index=True)
+    else:
+        missing_values = ['na', 'n/a', 'not available', 'none', 'not specified', 'not found', '-', '']
+        gender_rows = df_write[df_write['Attribute'] == 'Gender']
+        if not gender_rows.empty and gender_rows['Value'].isin(missing_values).any():
+            df_write.loc[df_write['Attribute'] == 'Gender', 'Value'] = gender_str
+
+    df_write = df_write.sort_values('Type', ascending=False)
+
+    return df_write
+
+
+def write_trial_output(df_write, trial_id, output_file_path):
+    import pandas as pd
+
+    if criteria_store is not None:
+        criteria_store.write_trial(trial_id, df_write.to_dict('records'))
+    if output_file_path is None:
+        return
+    if output_file_path.endswith('.jsonl'):
+        # appending json lines does not reload the output file, unlike the excel workbook
+        with open(output_file_path, 'a') as f:
+            df_write.to_json(f, orient='records', lines=True)
+            f.write('\n')
+        return
+    with pd.ExcelWriter(output_file_path, mode="a", engine="openpyxl", if_sheet_exists="overlay") as writer:
+        df_write.to_excel(writer, sheet_name=trial_id)
+
+
+def extract_packed_criteria(batch, open_trials, num_retries, delay_time, max_tokens, chunk_size):
+    item = batch['item']
+    sections = batch['sections']
+    trial_ids = [trial_id for trial_id, _ in sections]
+
+    if len(sections) == 1:
+        state = open_trials[trial_ids[0]]
+        state['df'] = extract_criteria(item, state['prompts'][item], state['trial'], state['df'], num_retries,
+                                       delay_time, max_tokens, chunk_size)
+        state['pending'] -= 1
+        return
+
+    packed_text = pack_sections(sections)
+    if item == 'in':
+        packed_prompt, o_p = generate_inclusion_criteria_prompt(packed_text, packed=True)
+    else:
+        packed_prompt, o_p = generate_exclusion_criteria_prompt(packed_text, packed=True)
+    batch_id = 'packed ' + ','.join(trial_ids)
+    print('Criteria text: {} of {} trials packed into one request'.format(item, len(sections)))
+
+    response_text_packed = generate_response_for_partial_doc(packed_prompt, o_p, num_retries, delay_time, max_tokens,
+                                                             batch_id, item, source_text=packed_text, packed=True)
+    if response_text_packed is None:
+        logging.warning('Trial IDs: {} -- Criteria: {} -- Packed request failed, extracting the sections '
+                        'separately'.format(','.join(trial_ids), item))
+        for trial_id in trial_ids:
+            state = open_trials[trial_id]
+            state['df'] = extract_criteria(item, state['prompts'][item], state['trial'], state['df'], num_retries,
+                                           delay_time, max_tokens, chunk_size)
+            state['pending'] -= 1
+        return
+
+    response_text_packed, truncated = response_text_packed
+    response_by_trial = demultiplex(response_text_packed, sections)
+    reextract = set()
+    if truncated:
+        # the model works through the sections in order: the last section with criteria was cut off,
+        # and the sections without any were not reached
+        reextract = set(trial_id for trial_id in trial_ids if not response_by_trial[trial_id])
+        reached = [trial_id for trial_id in trial_ids if response_by_trial[trial_id]]
+        if reached:
+            reextract.add(reached[-1])
+        logging.warning('Trial IDs: {} -- Criteria: {} -- Packed response was cut off, extracting {} of the sections '
+                        'separately'.format(','.join(trial_ids), item, len(reextract)))
+    for trial_id, section_text in sections:
+        state = open_trials[trial_id]
+        if trial_id in reextract:
+            state['df'] = extract_criteria(item, state['prompts'][item], state['trial'], state['df'], num_retries,
+                                           delay_time, max_tokens, chunk_size)
+        else:
+            state['df'] = process_half_text_response(response_by_trial[trial_id], state['df'], item,
+                                                     state['trial']['phase'], state['trial']['url'], trial_id,
+                                                     num_retries, delay_time, max_tokens, section_text)
+        state['pending'] -= 1
+
+
+def complete_trials(open_trials, output_file_path, trial_queue):
+    # writes every open trial that no longer waits for a packed request
+    for trial_id in [t_id for t_id, state in open_trials.items() if state['pending'] == 0]:
+        state = open_trials.pop(trial_id)
+        df_write = finalize_trial_output(state['df'], state['trial'])
+        write_trial_output(df_write, trial_id, output_file_path)
+        if trial_queue is not None:
+            trial_queue.mark_done(state['summary'])
+        logging.info('Tokens spent so far: {}'.format(token_budget.spent))
+
+
+def run_queue_worker(work_queue, worker_id, num_retries, delay_time, max_tokens, chunk_size):
+    # claims trials from the shared queue until none is pending or claimed (or the token budget is spent)
+    n_processed = 0
+    while not token_budget.exhausted():
+        # waits for the trials other workers hold, so an abandoned lease is reclaimed when it expires
+        claimed = work_queue.claim_next(worker_id)
+        if claimed is None:
+            break
+        trial_id = claimed['trial_id']
+        logging.info('Worker {} claimed trial ID: {}'.format(worker_id, trial_id))
+
+        with LeaseKeeper(work_queue, worker_id, trial_id) as lease:
+            try:
+                trial = read_trial(claimed['file'])
+            except Exception as e:
+                logging.error(str(e))
+                logging.error('Trial ID: {} -- ERROR: Could not parse trial file {}'.format(trial_id, claimed['file']))
+                work_queue.release(worker_id, trial_id, failed=True)
+                continue
+            try:
+                df_write = new_trial_output()
+                if trial is not None:
+                    for item, prompt in generate_prompts(trial['ex_criteria_text'], trial['in_criteria_text']).items():
+                        df_write = extract_criteria(item, prompt, trial, df_write, num_retries, delay_time, max_tokens,
+                                                    chunk_size)
+                    df_write = finalize_trial_output(df_write, trial)
+            except Exception:
+                # the trial goes back to the queue (failed after max_attempts claims), the worker keeps claiming
+                logging.exception('Trial ID: {} -- ERROR: Extraction failed, releasing the trial'.format(trial_id))
+                work_queue.release(worker_id, trial_id)
+                continue
 
-            url_str = trial_data.find('url').text
+        if lease.lost:
+            logging.warning('Trial ID: {} -- lease was lost while processing, result kept only if no other worker '
+                            'finished first'.format(trial_id))
+        work_queue.complete(worker_id, trial_id, df_write.to_dict(orient='records'))
+        n_processed += 1
+        logging.info('Tokens spent so far: {}'.format(token_budget.spent))
+    logging.info('Worker {} finished after {} trials'.format(worker_id, n_processed))
+
+
+def export_queue_results(work_queue, output_file_path):
+    import pandas as pd
+
+    for trial_id, rows in work_queue.results():
+        df_write = pd.DataFrame(rows, columns=new_trial_output().columns)
+        write_trial_output(df_write, trial_id, output_file_path)
+
+
+# Stages of the streaming pipeline (-stream). Each stage takes a trial job dict and returns the
+# jobs for the next stage; trials without eligibility criteria pass through with trial None so
+# that the writer can still mark them done in the queue.
+def parse_stage(summary):
+    return [{'summary': summary, 'trial': read_trial(summary['file'])}]
+
+
+def section_stage(job):
+    if job['trial'] is not None:
+        job['prompts'] = generate_prompts(job['trial']['ex_criteria_text'], job['trial']['in_criteria_text'])
+    return [job]
+
+
+def chunk_stage(job, chunk_size):
+    from nltk import word_tokenize
+
+    # short sections are extracted as a whole, longer ones chunk by chunk
+    job['units'] = []
+    for item, prompt in job.get('prompts', {}).items():
+        if len(word_tokenize(prompt['criteria_text'])) <= chunk_size:
+            job['units'].append(('section', item, prompt))
+        else:
+            job['units'].extend(('chunk', item, chunk) for chunk in chunk_criteria_text(prompt['criteria_text'], chunk_size))
+    del job['prompts']
+    return [job]
+
+
+def extract_stage(job, num_retries, delay_time, max_tokens, chunk_size):
+    df_write = new_trial_output()
+    for unit_type, item, unit in job.pop('units'):
+        if unit_type == 'section':
+            df_write = extract_criteria(item, unit, job['trial'], df_write, num_retries, delay_time, max_tokens, chunk_size)
+        else:
+            df_write = extract_criteria_chunk(item, unit, job['trial'], df_write, num_retries, delay_time, max_tokens)
+    job['df'] = df_write
+    return [job]
+
+
+def postprocess_stage(job):
+    if job['trial'] is not None:
+        job['df'] = finalize_trial_output(job['df'], job['trial'])
+    return [job]
+
+
+def write_stage(job, output_file_path, trial_queue):
+    if job['trial'] is not None:
+        write_trial_output(job['df'], job['trial']['trial_id'], output_file_path)
+        logging.info('Trial ID: {} written -- tokens spent so far: {}'.format(job['trial']['trial_id'], token_budget.spent))
+    if trial_queue is not None:
+        trial_queue.mark_done(job['summary'])
+    return []
+
+
+def run_streaming(source, output_file_path, trial_queue, num_retries, delay_time, max_tokens, chunk_size,
+                  extract_workers=4, queue_size=8):
+    # parsing, chunking and writing run in their own threads while extract_workers trials wait on the LLM
+    source = itertools.takewhile(lambda summary: not token_budget.exhausted(), source)
+    stages = [
+        Stage('parse', parse_stage),
+        Stage('section', section_stage),
+        Stage('chunk', functools.partial(chunk_stage, chunk_size=chunk_size)),
+        Stage('extract', functools.partial(extract_stage, num_retries=num_retries, delay_time=delay_time,
+                                           max_tokens=max_tokens, chunk_size=chunk_size), workers=extract_workers),
+        Stage('postprocess', postprocess_stage),
+        # a single writer, the output file is not safe for concurrent appends
+        Stage('write', functools.partial(write_stage, output_file_path=output_file_path, trial_queue=trial_queue)),
+    ]
+    run_pipeline(source, stages, queue_size=queue_size)
 
-            prompts_dict = generate_prompts(ex_criteria_text, in_criteria_text)
 
-            for item, prompt in prompts_dict.items():
+def add_common_arguments(parser):
+    # options shared by this script and worker.py
+    parser.add_argument('-log_file', '--log_file_path',
+                        help='File path to log file containing all information, warning and error messages')
+    parser.add_argument('-token_budget', '--max_tokens_per_run', type=int, default=None,
+                        help='Stop cleanly after the trial during which this many tokens have been spent')
+    parser.add_argument('-model', '--model_name', default='gpt-4',
+                        help='Chat model name passed to the OpenAI-compatible endpoint')
+    parser.add_argument('-base_url', '--api_base_url', default=None,
+                        help='Base URL of an OpenAI-compatible server (e.g. http://localhost:8000/v1); defaults to OPENAI_API_BASE or the OpenAI API')
+    parser.add_argument('-api_key', '--api_key', default=None,
+                        help='API key; defaults to the OPENAI_API_KEY environment variable')
+    parser.add_argument('-cascade_config', '--model_cascade_config', default=None,
+                        help='JSON file routing each prompt type (inclusion, exclusion, time_frame, diseases, treatments) to a model tier, with optional escalation')
+    parser.add_argument('-hedge_config', '--hedge_config', default=None,
+                        help='JSON file with per prompt type deadlines and hedging settings (latency percentile, max hedge rate)')
+    parser.add_argument('-record_file', '--record_llm_calls_file', default=None,
+                        help='Append every LLM request and response to this gzip compressed json lines file')
+    parser.add_argument('-replay_file', '--replay_llm_calls_file', default=None,
+                        help='Serve LLM responses from a file written with -record_file instead of calling the API')
+    parser.add_argument('-chunk_index', '--chunk_index_file', default=None,
+                        help='SQLite MinHash index of extracted chunks (can be shared by workers); criteria of lines unchanged in a near-duplicate chunk are reused')
+    parser.add_argument('-reuse_threshold', '--reuse_threshold', type=float, default=0.8,
+                        help='Minimum estimated Jaccard similarity of a chunk to an indexed chunk for reuse')
+    parser.add_argument('-worker_id', '--worker_id', default=None,
+                        help='Name of this worker in the work queue (default: <hostname>-<pid>)')
+    parser.add_argument('-lease_seconds', '--lease_seconds', type=int, default=600,
+                        help='A claimed trial is handed to another worker if its lease is not renewed within this time')
+
+
+def configure_run(args):
+    # logging, token budget, chunk index and model cascade from the add_common_arguments() options
+    global llm_cascade, chunk_index
+
+    logging.basicConfig(level=logging.INFO, filename=args.log_file_path,
+                        format='%(asctime)s [%(levelname)s] %(message)s',
+                        datefmt='%a, %d %b %Y %H:%M:%S')
+    token_budget.max_tokens = args.max_tokens_per_run
+    if args.chunk_index_file is not None:
+        chunk_index = ChunkIndex(args.chunk_index_file, threshold=args.reuse_threshold)
+    llm_cascade = load_cascade(args.model_cascade_config, model_name=args.model_name, base_url=args.api_base_url,
+                               api_key=args.api_key, record_path=args.record_llm_calls_file,
+                               replay_path=args.replay_llm_calls_file,
+                               hedge_config_path=args.hedge_config)
+    # tokens of losing hedges count against the budget too
+    llm_cascade.token_listener = token_budget.add
 
-                criteria_text_length = len(word_tokenize(prompt['criteria_text']))
-                if criteria_text_length <= chunk_size:
-                    print('Criteria text: {} of trial ID {} contains less than {} words'.format(item, trial_id, chunk_size))
 
-                    response_text = generate_response(prompt, num_retries, delay_time, max_tokens, trial_id, item)
+def run_report():
+    report = llm_cascade.report()
+    if chunk_index is not None:
+        report.extend(chunk_index.report())
+    return report
 
-                    if response_text == 'INPUT TOO LONG':
-                        # split criteria text into halves
-                        if item == 'in':
-                            first, second = divide_document(in_criteria_text)
-                            reduced_prompt_first_half, o_p_first = generate_inclusion_criteria_prompt(first)
-                            reduced_prompt_second_half, o_p_second = generate_inclusion_criteria_prompt(second)
 
-                        else:
-                            first, second = divide_document(ex_criteria_text)
+if __name__ == '__main__':
+    from tqdm import tqdm
+    from nltk import word_tokenize
 
-                            reduced_prompt_first_half, o_p_first = generate_exclusion_criteria_prompt(first)
-                            reduced_prompt_second_half, o_p_second = generate_exclusion_criteria_prompt(second)
+    parser = argparse.ArgumentParser(description='Running GPT on clinical trial documents to extract eligibility criteria.')
+    parser.add_argument('-input_file', '--input_xml_file', help='File path to the directory of xml files containing raw clinical trial data (searched recursively)')
+    parser.add_argument('-output_file', '--output_file_extracted_entities',
+                        help='File path to an excel file storing all extracted criteria with each sheet containing criteria for a trial document')
+    add_common_arguments(parser)
+    parser.add_argument('-criteria_store', '--criteria_store_file', default=None,
+                        help='Also write the extracted criteria into this SQLite store, indexed for queries with criteria_store.py')
+    parser.add_argument('-manifest', '--trial_ids_manifest', default=None,
+                        help='Text file with one NCT ID per line; only these trials are processed (looked up directly in their NCTxxxxxxxx/ shard)')
+    parser.add_argument('-id_range', '--trial_id_range', default=None,
+                        help='Only process trials in this inclusive NCT ID range, e.g. NCT00000100-NCT00999999')
+    parser.add_argument('-where', '--where', default=None,
+                        help='Only process trials whose structured fields match, e.g. "phase in (2, 2/3) and overall_status = Recruiting '
+                             'and condition ~ steatohepatitis and start_date >= 2015-01" (fields: nct_id, phase, overall_status, '
+                             'condition, study_type, start_date)')
+    parser.add_argument('-trial_index', '--trial_index_file', default=None,
+                        help='SQLite sidecar index of the structured trial fields, used to answer -where without reading the xml files')
+    parser.add_argument('-build_index', '--build_trial_index', action='store_true',
+                        help='Add new and changed trial files of -input_file to -trial_index (without -output_file or -work_queue, only the index is built)')
+    parser.add_argument('-priority_file', '--priority_trial_ids_file', default=None,
+                        help='Text file with one NCT ID per line; these trials are processed first, in file order')
+    parser.add_argument('-priority_phases', '--priority_phases', default=None,
+                        help='Comma separated phases to process next, in order (e.g. "3,2/3")')
+    parser.add_argument('-pack_token_budget', '--pack_token_budget', type=int, default=None,
+                        help='Pack short criteria sections from different trials into shared requests of at most this many prompt tokens')
+    parser.add_argument('-pack_max_words', '--pack_max_section_words', type=int, default=100,
+                        help='Only sections with at most this many words are packed')
+    parser.add_argument('-work_queue', '--work_queue_file', default=None,
+                        help='SQLite file shared by worker processes on one or more hosts; enables -enqueue, -worker and -export_results')
+    parser.add_argument('-enqueue', '--enqueue_trials', action='store_true',
+                        help='Add the trial files of -input_file to the work queue in priority order')
+    parser.add_argument('-worker', '--run_worker', action='store_true',
+                        help='Claim and process trials from the work queue until it is empty')
+    parser.add_argument('-export_results', '--export_queue_results', action='store_true',
+                        help='Write all results collected in the work queue to -output_file')
+    parser.add_argument('-stream', '--streaming_pipeline', action='store_true',
+                        help='Run parsing, chunking, extraction and writing as concurrent stages connected by bounded queues (constant memory)')
+    parser.add_argument('-extract_workers', '--extract_workers', type=int, default=4,
+                        help='Number of trials extracted concurrently in -stream mode')
+    parser.add_argument('-pipeline_queue_size', '--pipeline_queue_size', type=int, default=8,
+                        help='Capacity of each queue between the -stream stages')
+    parser.add_argument('-queue_file', '--queue_state_file', default=None,
+                        help='JSON file holding the pending trial queue; trials left over when the budget is reached are resumed from here')
 
+    args = parser.parse_args()
+    if args.pack_token_budget is not None and (args.streaming_pipeline or args.work_queue_file is not None):
+        parser.error('-pack_token_budget is only supported in the default run, not with -stream or -work_queue')
+    if args.input_xml_file is None:
+        if args.build_trial_index:
+            parser.error('-build_index requires -input_file')
+        # trial files are discovered for every run except queue workers and exports, unless the index answers -where
+        selects_trials = args.enqueue_trials if args.work_queue_file is not None else True
+        if selects_trials and (args.where is None or args.trial_index_file is None):
+            parser.error('-input_file is required (or -trial_index with -where to select trials from the index)')
 
-                        response_text_first = generate_response_for_partial_doc(reduced_prompt_first_half, o_p_first, num_retries,
-                                                                                delay_time, max_tokens, trial_id, item)
-                        response_text_second = generate_response_for_partial_doc(reduced_prompt_second_half, o_p_second,
-                                                                                 num_retries, delay_time, max_tokens,
-                                                                                 trial_id, item)
-                        df_write = process_half_text_response(response_text_first, df_write, item, phase_str, url_str,
-                                                              trial_id, num_retries, delay_time, max_tokens, prompt['criteria_text'])
-                        df_write = process_half_text_response(response_text_second, df_write, item, phase_str, url_str,
-                                                              trial_id, num_retries, delay_time, max_tokens, prompt['criteria_text'])
+    input_file_path = args.input_xml_file
 
-                    elif response_text is not None:
-                        if item == 'in':
-                            df_write = process(response_text, df_write, 'Inclusion', trial_id, num_retries, delay_time,
-                                               max_tokens, phase_str, url_str, prompt['criteria_text'])
-                        else:
-                            df_write = process(response_text, df_write, 'Exclusion', trial_id, num_retries, delay_time,
-                                               max_tokens, phase_str, url_str, prompt['criteria_text'])
-                else:
-                    print('Criteria text: {} of trial ID {} contains more than {} words'.format(item, trial_id, chunk_size))
-
-                    # Dividing the criteria text into chunks preserving sentence boundaries
-                    chunks = []
-                    chunk = ''
-                    words = 0
-                    # for sentence in re.split(r'(\. |\? |\! |\n)', prompt['criteria_text']):
-                    for sentence in re.split(r'(\. |\? )', prompt['criteria_text']):
-                        # print('Sentence: \n')
-                        # print(sentence)
-                        if len(sentence.strip()) > 0:
-                            sentence_words = len(word_tokenize(sentence))
-                            if words + sentence_words <= chunk_size:
-                                chunk += sentence + ' '
-                                words += sentence_words
-                            else:
-                                chunks.append(chunk)
-                                chunk = sentence + ' '
-                                words = sentence_words
-                    if len(chunk) > 0:
-                        chunks.append(chunk)
-
-                    for chunk in chunks:
-                        # print('Chunk:\n')
-                        # print(chunk)
-
-                        # Chunks that only contain a one or two-digit number followed by a period.
-                        pattern = r"^\d{1,2}\.$"
-                        match = re.match(pattern, chunk)
-                        if match:
-                            continue
-
-                        if item == 'in':
-                            reduced_prompt_chunk, o_p = generate_inclusion_criteria_prompt(chunk)
-                        else:
-                            reduced_prompt_chunk, o_p = generate_exclusion_criteria_prompt(chunk)
-
-                        response_text_chunk = generate_response_for_partial_doc(reduced_prompt_chunk, o_p, num_retries,
-                                                                                delay_time, max_tokens, trial_id, item)
-                        # print("Response: \n")
-                        # print(response_text_chunk)
-                        df_write = process_half_text_response(response_text_chunk, df_write, item, phase_str, url_str,
-                                                              trial_id, num_retries, delay_time, max_tokens, chunk)
-
-            df_write['Attribute'] = df_write['Attribute'].str.replace(r'(^(-|\s-))', '', regex=True)
-            df_write['Attribute'] = df_write['Attribute'].str.replace(r'(^(?:[1-9]|[1-9][0-9]|100)\. ?)', '', regex=True)
-            df_write['Attribute'] = df_write['Attribute'].str.strip()
-            df_write['Attribute_Lowercase'] = df_write['Attribute'].str.lower()
-
-
-            def is_substring(row):
-                text = row['Attribute'].lower()
-                for other_text in df_write['Attribute'].str.lower():
-                    # here we apply the length of text constraint to avoid removing short attributes such as ast and alt which can occur as a substring in other attribute phrases
-                    if text in other_text and text != other_text and len(text) > 4:
-                        return True
-                return False
-
-
-            # to select the longest overlapping attribute phrase
-            df_write = df_write[~df_write.apply(is_substring, axis=1)]
-            
-            # dropping duplicate attribute phrases for Comorbidity, Lab Test, and Treatment History entities
-            df_write_com_lab = df_write[df_write['Entity'].isin(['Comorbidity', 'Lab Test', 'Treatment History'])].copy()
-            df_write_com_lab_dedup = df_write_com_lab.drop_duplicates(subset=['Attribute_Lowercase'], keep='first')
-            df_write_others = df_write[~df_write['Entity'].isin(['Comorbidity', 'Lab Test', 'Treatment History'])].copy()
-            component_dfs = [df_write_com_lab_dedup, df_write_others]
-            df_write_com_lab_dedup_plus_others_all = pd.concat(component_dfs)
-            df_write = df_write_com_lab_dedup_plus_others_all.drop(columns=['Attribute_Lowercase'])
-
-
-            for i in range(len(df_write)):
-                row = df_write.iloc[i]
-
-                # adding in-situ to allowed excepted cancers
-                # can make it more restrictive
-                cancer_related_words = ['cancer', 'carcinoma', 'dysplasia']
-                # if row['Entity'].lower().strip() == 'comorbidity' and any(c in row['Attribute'].lower().strip() for c in
-                #                                                          cancer_related_words) and row['Value'].lower().strip() == 'allowed':
-                # rule for excepted cancers
-                if row['Entity'].lower().strip() == 'comorbidity' and any(c in row['Attribute'].lower().strip() for c in cancer_related_words) and 'meningitis' not in row['Attribute'].lower():
-                    corresponding_sent = row['Source Sentence'].lower().strip()
-                    original_attr = row['Attribute'].strip()
-                    for word in ['except', 'excluding', 'permitted', 'allowed', 'still eligible', 'may be eligible']:
-                        if word in corresponding_sent:
-                            index = corresponding_sent.index(word) + len(word) + 1  # index of the word after the matched word
-                            if any(c in corresponding_sent[index:] for c in cancer_related_words):
-                                row['Attribute'] = original_attr + ', (in-situ)'
-                                row['Value'] = 'Allowed'
-                                break
-
-            # remove "Prior LOT" attributes, any attribute phrase containing "Any", and any attribute containing none-like values
-            df_write = df_write[~df_write['Attribute'].isin(['Prior LOT', 'Any'])]
-            search_for_none_values = ['none', 'n/a', 'not mentioned', 'not specified', 'not available', 'not found', 'not applicable']
-            df_write = df_write[~df_write['Attribute'].str.contains('|'.join(search_for_none_values), case=False)]
+    trial_index = 0
 
-            
-            df_write = df_write[
-                ~df_write['Attribute'].str.lower().isin(
-                    ['no diseases are mentioned in this sentence.', 'no diseases mentioned in this sentence.',
-                     'no specific diseases mentioned', 'no specific diseases are mentioned',
-                     'there are no diseases mentioned in this sentence.',
-                     'there are no specific diseases mentioned in this sentence.',
-                     'there are no specific treatment names, therapy names, medication or drug names, or procedure names mentioned in this sentence.',
-                     'there are no treatment names, therapy names, medication or drug names, or procedure names mentioned in this sentence.',
-                     'there are no specific disease or health condition terms mentioned in this sentence.',
-                     'there are no disease or health condition terms mentioned in this sentence.',
-                     'there are no disease, health condition, or comorbidity terms mentioned in this sentence.',
-                     'there are no disease or health condition terms mentioned in the given sentence.'])]
+    output_file_path = args.output_file_extracted_entities
+    configure_run(args)
+    if args.criteria_store_file is not None:
+        criteria_store = CriteriaStore(args.criteria_store_file)
+    priority_spec = load_priority_spec(args.priority_trial_ids_file, args.priority_phases)
+    # trials are only read up front and ordered when a priority order or queue state file is given
+    scheduled = (args.queue_state_file is not None or args.priority_trial_ids_file is not None
+                 or args.priority_phases is not None)
+    trial_queue = TrialQueue(args.queue_state_file) if scheduled else None
+    manifest_ids = load_manifest(args.trial_ids_manifest) if args.trial_ids_manifest is not None else None
+    id_range = parse_id_range(args.trial_id_range) if args.trial_id_range is not None else None
+    where_clauses = parse_where(args.where) if args.where is not None else None
+    trial_index_db = TrialIndex(args.trial_index_file) if args.trial_index_file is not None else None
+    if args.build_trial_index:
+        if trial_index_db is None:
+            parser.error('-build_index requires -trial_index')
+        trial_index_db.build(discover_trials(input_file_path))
+        if output_file_path is None and args.criteria_store_file is None and args.work_queue_file is None:
+            sys.exit(0)
+    select_files = functools.partial(find_trial_files, input_file_path, manifest_ids, id_range, where_clauses,
+                                     trial_index_db)
+
+    if args.work_queue_file is not None:
+        work_queue = WorkQueue(args.work_queue_file, lease_seconds=args.lease_seconds)
+        if args.enqueue_trials:
+            work_queue.enqueue(order_trials([read_trial_summary(filename) for filename in select_files()], priority_spec))
+        if args.run_worker:
+            run_queue_worker(work_queue, args.worker_id or default_worker_id(), num_retries, delay_time, max_tokens,
+                             chunk_size)
+        if args.export_queue_results:
+            export_queue_results(work_queue, output_file_path)
+        logging.info('Work queue status: {}'.format(work_queue.counts()))
+    elif args.streaming_pipeline:
+        if scheduled:
+            source = schedule_trials(list(select_files()), trial_queue, priority_spec, token_budget)
+        else:
+            # without a priority order or queue state the trial files are streamed as they are discovered
+            source = ({'file': filename} for filename in select_files())
+        run_streaming(source, output_file_path, trial_queue, num_retries, delay_time, max_tokens, chunk_size,
+                      extract_workers=args.extract_workers, queue_size=args.pipeline_queue_size)
+    else:
+        packer = None
+        if args.pack_token_budget is not None:
+            preamble_tokens = {
+                'in': count_tokens(generate_inclusion_criteria_prompt('', packed=True)[0].format(disease=disease_text)),
+                'ex': count_tokens(generate_exclusion_criteria_prompt('', packed=True)[0].format(disease=disease_text)),
+            }
+            packer = SectionPacker(args.pack_token_budget, preamble_tokens, max_section_words=args.pack_max_section_words)
+        # trials whose output is not written yet, keyed by trial ID; 'pending' counts sections waiting in the packer
+        open_trials = {}
+
+        if scheduled:
+            source = schedule_trials(list(select_files()), trial_queue, priority_spec, token_budget)
+        else:
+            # the first trial starts as soon as its file is discovered
+            source = itertools.takewhile(lambda summary: not token_budget.exhausted(),
+                                         ({'file': filename} for filename in select_files()))
+
+        for trial_summary in tqdm(source):
+            trial = read_trial(trial_summary['file'])
+            if trial is None:
+                if trial_queue is not None:
+                    trial_queue.mark_done(trial_summary)
+                continue
+            trial_id = trial['trial_id']
 
-            
-            df_write = df_write[
-                ~df_write['Attribute'].str.lower().isin(
-                    ['other disease', 'other diseases', 'procedure', 'procedures', 'comorbidity', 'comorbidities',
-                     'medication', 'medications',
-                     'contraception-related criteria', 'treatments or therapies', 'treatment or therapy', 'treatments',
-                     'therapies', 'drugs', 'treatment', 'therapy', 'drug', 'contraception', 'diagnosis', 'diagnoses',
-                     'other diseases or comorbidities', 'other disease or comorbidity', 'prior therapy',
-                     'prior treatment', 'prior therapies', 'prior treatments', 'gene', 'gene product', 'receptor',
-                     'hormone receptor', 'imaging biomarker',
-                     'genes', 'gene products', 'receptors', 'hormone receptors', 'imaging biomarkers', 'imaging scan',
-                     'imaging scans', 'complication', 'complications', 'issues', 'issue',
-                     'side effects', 'syndromes', 'adverse events', 'side effect', 'syndrome', 'adverse event',
-                     'mental issue', 'mental issues', 'allergy', 'disorder', 'symptoms', 'abnormalities', 'symptom', 'disorders'])]
-
-            # Populating available values for age and gender
-            if min_age_str is not None and max_age_str is not None:
-                age_str = '>=' + min_age_str + ' and ' + '<=' + max_age_str
-                df_write.loc[df_write['Attribute'] == 'Age', 'Value'] = age_str
-            elif min_age_str is None and max_age_str is not None:
-                age_str = '<=' + max_age_str
-                df_write.loc[df_write['Attribute'] == 'Age', 'Value'] = age_str
-            elif min_age_str is not None and max_age_str is None:
-                age_str = '>=' + min_age_str
-            else:
-                age_str = 'NA'
-
-            if gender_str is None:
-                gender_str = 'NA'
-
-            if not df_write['Attribute'].isin(['Age']).any():
-                new_df = pd.DataFrame(
-                    {'Trial ID': [trial_id], 'Type': ['Inclusion'], 'Phase': [phase_str], 'URL': [url_str],
-                     'Entity': ['Demographic'],
-                     'Attribute': ['Age'], 'Value': [age_str], 'Temporal': ['NA'],
-                     'Modifier': ['NA'], 'Source Sentence': ['Extracted from structured field.']})
-                df_write = pd.concat([df_write, new_df], ignore_index=True)
-            else:
-                missing_values = ['na', 'n/a', 'not available', 'none', 'not specified', 'not found', '-', '']
-                age_rows = df_write[df_write['Attribute'] == 'Age']
-                if not age_rows.empty and age_rows['Value'].isin(missing_values).any():
-                    df_write.loc[df_write['Attribute'] == 'Age', 'Value'] = age_str
-
-            if not df_write['Attribute'].isin(['Gender']).any():
-                new_df = pd.DataFrame(
-                    {'Trial ID': [trial_id], 'Type': ['Inclusion'], 'Phase': [phase_str], 'URL': [url_str],
-                     'Entity': ['Demographic'],
-                     'Attribute': ['Gender'], 'Value': [gender_str], 'Temporal': ['NA'],
-                     'Modifier': ['NA'], 'Source Sentence': ['Extracted from structured field.']})
-                df_write = pd.concat([df_write, new_df], ignore_index=True)
-            else:
-                missing_values = ['na', 'n/a', 'not available', 'none', 'not specified', 'not found', '-', '']
-                gender_rows = df_write[df_write['Attribute'] == 'Gender']
-                if not gender_rows.empty and gender_rows['Value'].isin(missing_values).any():
-                    df_write.loc[df_write['Attribute'] == 'Gender', 'Value'] = gender_str
+            seq_num = int(trial_index) + 1
+            trial_index = seq_num
+            logging.info('Processing sequence number: {}, with trial ID: {}\n'.format(seq_num, trial_id))
 
-            df_write = df_write.sort_values('Type', ascending=False)
+            state = {'trial': trial, 'summary': trial_summary, 'df': new_trial_output(), 'pending': 0,
+                     'prompts': generate_prompts(trial['ex_criteria_text'], trial['in_criteria_text'])}
+            open_trials[trial_id] = state
 
-            with pd.ExcelWriter(output_file_path, mode="a", engine="openpyxl", if_sheet_exists="overlay") as writer:
-                df_write.to_excel(writer, sheet_name=trial_id)
+            for item, prompt in state['prompts'].items():
+                if packer is not None and packer.accepts(len(word_tokenize(prompt['criteria_text']))):
+                    state['pending'] += 1
+                    closed_batch = packer.add(item, trial_id, prompt['criteria_text'])
+                    if closed_batch is not None:
+                        extract_packed_criteria(closed_batch, open_trials, num_retries, delay_time, max_tokens, chunk_size)
+                else:
+                    state['df'] = extract_criteria(item, prompt, trial, state['df'], num_retries, delay_time, max_tokens,
+                                                   chunk_size)
+
+            complete_trials(open_trials, output_file_path, trial_queue)
+
+        if packer is not None:
+            for batch in packer.flush():
+                extract_packed_criteria(batch, open_trials, num_retries, delay_time, max_tokens, chunk_size)
+            complete_trials(open_trials, output_file_path, trial_queue)
+        if trial_queue is not None:
+            logging.info('{} trials left in queue'.format(len(trial_queue)))
+
+    logging.info('Run finished: {} tokens spent'.format(token_budget.spent))
+    for line in run_report():
+        logging.info(line)
+        print(line)
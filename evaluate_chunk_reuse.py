@@ -0,0 +1,112 @@
+import os
+import argparse
+import logging
+import tempfile
+import itertools
+import eligibility_criteria_extraction as extraction
+from model_cascade import load_cascade
+from trial_discovery import discover_trials
+from section_packer import count_tokens
+from chunk_dedup import ChunkIndex, split_units, assign_criteria, normalize_unit
+
+
+# Replays a recorded full extraction run (-record_file) chunk by chunk and measures what near-duplicate
+# chunk reuse (-chunk_index) would have saved, and how well the reused criteria agree with the criteria
+# the full re-extraction of the same lines produced. The index is built from the full extractions, so
+# every chunk is compared with what was really extracted before it in the run.
+
+def criteria_key(extracted_criteria):
+    return (str(extracted_criteria.get('Entity', '')).strip().lower(),
+            normalize_unit(str(extracted_criteria.get('Attribute', ''))),
+            str(extracted_criteria.get('Value', '')).strip().lower())
+
+
+def count_matches(expected, got):
+    remaining = list(expected)
+    matches = 0
+    for key in got:
+        if key in remaining:
+            remaining.remove(key)
+            matches += 1
+    return matches
+
+
+if __name__ == '__main__':
+    from nltk import word_tokenize
+
+    parser = argparse.ArgumentParser(description='Measure near-duplicate chunk reuse against full re-extraction on a recorded run.')
+    parser.add_argument('-input_file', '--input_xml_file', required=True,
+                        help='Directory of xml files of the recorded run (searched recursively)')
+    parser.add_argument('-replay_file', '--replay_llm_calls_file', required=True,
+                        help='LLM calls of the full run, written with -record_file')
+    parser.add_argument('-model', '--model_name', default='gpt-4', help='Model name of the recorded run')
+    parser.add_argument('-cascade_config', '--model_cascade_config', default=None,
+                        help='Cascade config of the recorded run, if one was used')
+    parser.add_argument('-reuse_threshold', '--reuse_threshold', type=float, default=0.8,
+                        help='Minimum estimated Jaccard similarity of a chunk to an indexed chunk for reuse')
+    parser.add_argument('-limit', '--max_trials', type=int, default=None, help='Only replay the first this many trials')
+    parser.add_argument('-log_file', '--log_file_path', help='File path to log file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, filename=args.log_file_path,
+                        format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%a, %d %b %Y %H:%M:%S')
+    extraction.llm_cascade = load_cascade(args.model_cascade_config, model_name=args.model_name,
+                                          replay_path=args.replay_llm_calls_file)
+    index_file = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False)
+    index_file.close()
+    chunk_index = ChunkIndex(index_file.name, threshold=args.reuse_threshold)
+    preamble_tokens = {
+        'in': count_tokens(extraction.generate_inclusion_criteria_prompt('')[0].format(disease=extraction.disease_text)),
+        'ex': count_tokens(extraction.generate_exclusion_criteria_prompt('')[0].format(disease=extraction.disease_text)),
+    }
+
+    chunks = 0
+    replay_misses = 0
+    chunk_tokens = 0
+    saved_tokens = 0
+    matches = 0
+    expected_total = 0
+    reused_total = 0
+
+    for filename in itertools.islice(discover_trials(args.input_xml_file), args.max_trials):
+        trial = extraction.read_trial(filename)
+        if trial is None:
+            continue
+        for item, prompt in extraction.generate_prompts(trial['ex_criteria_text'], trial['in_criteria_text']).items():
+            # only sections long enough to be chunked go through the chunk index in a real run
+            if len(word_tokenize(prompt['criteria_text'])) <= extraction.chunk_size:
+                continue
+            for chunk in extraction.chunk_criteria_text(prompt['criteria_text'], extraction.chunk_size):
+                full = extraction.generate_chunk_response(item, chunk, trial['trial_id'], 1, 0, extraction.max_tokens)
+                if full is None:
+                    replay_misses += 1
+                    continue
+                chunks += 1
+                chunk_tokens += preamble_tokens[item] + count_tokens(chunk)
+
+                reused, fresh_units, similarity = chunk_index.lookup(item, chunk)
+                if similarity is not None:
+                    units = split_units(chunk)
+                    fresh = set(normalize_unit(unit) for unit in fresh_units)
+                    per_unit, _ = assign_criteria([normalized for _, normalized in units], full)
+                    expected = [criteria_key(c) for (_, normalized), unit_criteria in zip(units, per_unit)
+                                if normalized not in fresh for c in unit_criteria]
+                    got = [criteria_key(c) for c in reused]
+                    matches += count_matches(expected, got)
+                    expected_total += len(expected)
+                    reused_total += len(got)
+                    saved_tokens += sum(count_tokens(original) for original, normalized in units if normalized not in fresh)
+                    if len(fresh_units) == 0:
+                        saved_tokens += preamble_tokens[item]
+                if similarity is None or len(fresh_units) > 0:
+                    chunk_index.add(item, chunk, full)
+
+    os.remove(index_file.name)
+    for line in chunk_index.report():
+        print(line)
+    print('Replayed {} chunks ({} replay misses skipped): {} of {} prompt tokens saved ({:.1%})'.format(
+        chunks, replay_misses, saved_tokens, chunk_tokens, saved_tokens / chunk_tokens if chunk_tokens else 0.0))
+    print('Reused criteria vs full re-extraction of the unchanged lines: precision {:.3f}, recall {:.3f} '
+          '({} reused, {} extracted, {} matching on entity/attribute/value)'.format(
+              matches / reused_total if reused_total else 1.0, matches / expected_total if expected_total else 1.0,
+              reused_total, expected_total, matches))
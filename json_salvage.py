@@ -0,0 +1,121 @@
+import re
+import json
+
+
+decoder = json.JSONDecoder()
+
+object_start_pattern = re.compile(r'[\[{]')
+trailing_comma_pattern = re.compile(r',\s*([}\]])')
+# criteria are separated by line breaks (bullet lists without final periods) or sentence ends,
+# but not by the period of a "1." list number
+sentence_split_pattern = re.compile(r'\n+|(?<=[^\d\s][.?;])\s+')
+list_marker_pattern = re.compile(r'^(?:[-*•]|\(?\d{1,3}[.)]|\(?[a-z][.)])\s+')
+
+criteria_keys = ('Entity', 'Attribute', 'Value', 'Condition', 'Sentence')
+# an object without these is not a usable criterion; the other criteria keys default to 'NA'
+required_keys = ('Entity', 'Attribute')
+
+
+def _decode(text, position):
+    try:
+        return decoder.raw_decode(text, position)
+    except ValueError:
+        pass
+    # models often leave a trailing comma before a closing bracket; retry the enclosing block without it
+    fence_end = text.find('```', position)
+    block = text[position:fence_end if fence_end >= 0 else len(text)]
+    repaired = trailing_comma_pattern.sub(r'\1', block)
+    if repaired == block:
+        raise ValueError('not a json value')
+    value, _ = decoder.raw_decode(repaired)
+    return value, position + len(block)
+
+
+def _complete(criteria):
+    # process() reads every criteria key as a string
+    if any(not isinstance(criteria.get(key), str) or not criteria[key].strip() for key in required_keys):
+        return []
+    criteria = dict(criteria)
+    for key in criteria_keys:
+        if criteria.get(key) is None:
+            criteria[key] = 'NA'
+        elif not isinstance(criteria[key], str):
+            criteria[key] = str(criteria[key])
+    return [criteria]
+
+
+def _criteria_objects(value):
+    if isinstance(value, dict):
+        if any(key in value for key in criteria_keys):
+            return _complete(value)
+        # a wrapper like {"criteria": [...]}
+        return [o for v in value.values() if isinstance(v, list) for o in _criteria_objects(v)]
+    if isinstance(value, list):
+        return [o for v in value for o in _criteria_objects(v)]
+    return []
+
+
+def parse_json_objects(output):
+    # Tolerant replacement for splitting the output on ```json fences and json.loads-ing each block.
+    # Scans the whole output and keeps every well-formed criteria object, so one malformed or cut-off
+    # block no longer throws away the others. A list that was cut off still yields its complete objects
+    # because scanning resumes inside it. Returns (objects, truncated), where truncated tells whether
+    # some json after the last parsed object could not be decoded (usually the output limit was hit).
+    objects = []
+    position = 0
+    last_end = 0
+    while True:
+        match = object_start_pattern.search(output, position)
+        if match is None:
+            break
+        try:
+            value, end = _decode(output, match.start())
+        except ValueError:
+            position = match.start() + 1
+            continue
+        found = _criteria_objects(value)
+        if found:
+            objects.extend(found)
+            last_end = end
+        position = end
+    tail = output[last_end:]
+    truncated = '{' in tail and '"' in tail
+    return objects, truncated
+
+
+def _sentence_spans(text):
+    spans = []
+    start = 0
+    for match in sentence_split_pattern.finditer(text):
+        if text[start:match.start()].strip():
+            spans.append((start, match.start()))
+        start = match.end()
+    if text[start:].strip():
+        spans.append((start, len(text)))
+    return spans
+
+
+def split_sentences(text):
+    return [text[start:end] for start, end in _sentence_spans(text)]
+
+
+def _normalize(text):
+    text = ' '.join(str(text).lower().split())
+    return list_marker_pattern.sub('', text).strip(' .;')
+
+
+def unprocessed_text(source_text, objects):
+    # The model works through the criteria text in order, so after a cut-off response everything
+    # after the last sentence quoted under "Sentence" still needs to be extracted.
+    spans = _sentence_spans(source_text)
+    quoted = [_normalize(o.get('Sentence', '')) for o in objects if isinstance(o, dict)]
+    # 'na' is the placeholder for a missing sentence, see _complete()
+    quoted = [q for q in quoted if q and q != 'na']
+    last_index = -1
+    for i, (start, end) in enumerate(spans):
+        sentence_norm = _normalize(source_text[start:end])
+        if any(q in sentence_norm or (sentence_norm and sentence_norm in q) for q in quoted):
+            last_index = i
+    if last_index < 0:
+        return None
+    return source_text[spans[last_index][1]:].strip() or None
@@ -0,0 +1,127 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+import threading
+
+
+# shared by all recording backends, which may append to the same log file
+record_lock = threading.Lock()
+
+
+def request_key(model_name, prompt_text):
+    return hashlib.sha256((model_name + '\n' + prompt_text).encode('utf-8')).hexdigest()
+
+
+class OpenAIBackend:
+    # Any OpenAI-compatible chat completion endpoint. base_url can point at a local
+    # inference server (e.g. vLLM or llama.cpp serving the OpenAI API).
+    def __init__(self, model_name='gpt-4', base_url=None, api_key=None, temperature=0, request_timeout=None):
+        self.model_name = model_name
+        self.request_timeout = request_timeout
+        self.base_url = base_url or os.environ.get('OPENAI_API_BASE')
+        self.api_key = api_key or os.environ.get('OPENAI_API_KEY')
+        self.temperature = temperature
+        self._llm = None
+
+    def _get_llm(self):
+        # created on first use so that importing the script neither loads langchain nor requires an API key
+        if self._llm is None:
+            from langchain.chat_models import ChatOpenAI
+
+            kwargs = {'model_name': self.model_name, 'temperature': self.temperature}
+            if self.base_url:
+                kwargs['openai_api_base'] = self.base_url
+            if self.api_key:
+                kwargs['openai_api_key'] = self.api_key
+            if self.request_timeout:
+                kwargs['request_timeout'] = self.request_timeout
+            self._llm = ChatOpenAI(**kwargs)
+        return self._llm
+
+    def complete(self, prompt_text):
+        # returns the response text and the total number of tokens used by the call
+        from langchain.schema import HumanMessage
+
+        result = self._get_llm().generate([[HumanMessage(content=prompt_text)]])
+        output = result.generations[0][0].text
+        token_usage = (result.llm_output or {}).get('token_usage', {})
+        return output, token_usage.get('total_tokens', 0)
+
+
+class RecordingBackend:
+    # Wraps another backend and appends every request/response pair to a gzip compressed
+    # json lines file that ReplayBackend can serve back later.
+    def __init__(self, backend, log_path):
+        self.backend = backend
+        self.model_name = backend.model_name
+        self.log_path = log_path
+
+    def complete(self, prompt_text):
+        output, total_tokens = self.backend.complete(prompt_text)
+        record = {'key': request_key(self.model_name, prompt_text), 'model': self.model_name,
+                  'prompt': prompt_text, 'response': output, 'total_tokens': total_tokens}
+        with record_lock:
+            # every record is its own gzip member, so an interrupted run still leaves a readable log
+            with gzip.open(self.log_path, 'at', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+        return output, total_tokens
+
+
+def read_recording(log_path):
+    records = {}
+    with gzip.open(log_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                records.setdefault(record['key'], []).append(record)
+    return records
+
+
+recordings = {}
+
+
+def load_recording(log_path):
+    # several replay backends (one per model) can share one recording file
+    if log_path not in recordings:
+        recordings[log_path] = read_recording(log_path)
+    return recordings[log_path]
+
+
+class ReplayMissError(KeyError):
+    pass
+
+
+class ReplayBackend:
+    # Serves responses from a RecordingBackend log without any network access. Identical
+    # prompts recorded several times are replayed in recording order.
+    def __init__(self, log_path, model_name='gpt-4', records=None):
+        self.model_name = model_name
+        self.log_path = log_path
+        self.records = records if records is not None else load_recording(log_path)
+        self._served = {}
+        self._lock = threading.Lock()
+
+    def complete(self, prompt_text):
+        key = request_key(self.model_name, prompt_text)
+        if key not in self.records:
+            logging.error('Replay: no recorded response for model {} (key {})'.format(self.model_name, key))
+            raise ReplayMissError(key)
+        with self._lock:
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+        recorded = self.records[key]
+        record = recorded[min(index, len(recorded) - 1)]
+        return record['response'], record['total_tokens']
+
+
+def create_backend(model_name='gpt-4', base_url=None, api_key=None, record_path=None, replay_path=None,
+                   request_timeout=None):
+    if replay_path is not None:
+        return ReplayBackend(replay_path, model_name=model_name)
+    backend = OpenAIBackend(model_name=model_name, base_url=base_url, api_key=api_key, request_timeout=request_timeout)
+    if record_path is not None:
+        backend = RecordingBackend(backend, record_path)
+    return backend
@@ -0,0 +1,76 @@
+import json
+import time
+import random
+import argparse
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from llm_backends import load_recording, request_key
+
+
+# Local stand-in for an OpenAI-compatible chat completion server, for exercising timeouts and
+# hedging (-hedge_config) without API calls. Responses come from a -record_file recording when one
+# is given, otherwise every prompt is answered with 'NA'. A fraction of the requests is stalled to
+# simulate tail latency. Point the extraction at it with -base_url http://localhost:<port>/v1
+class MockCompletionHandler(BaseHTTPRequestHandler):
+    records = None
+    latency = 0.0
+    slow_fraction = 0.0
+    slow_seconds = 0.0
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        model_name = request.get('model', 'gpt-4')
+        prompt_text = request['messages'][-1]['content']
+
+        content, total_tokens = 'NA', len(prompt_text.split())
+        if self.records is not None:
+            recorded = self.records.get(request_key(model_name, prompt_text))
+            if recorded:
+                content, total_tokens = recorded[0]['response'], recorded[0]['total_tokens']
+
+        delay = self.latency
+        if random.random() < self.slow_fraction:
+            delay += self.slow_seconds
+            logging.info('Injecting a {:.1f}s stall'.format(delay))
+        time.sleep(delay)
+
+        body = json.dumps({
+            'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': model_name,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': total_tokens, 'completion_tokens': 0, 'total_tokens': total_tokens},
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Local stand-in OpenAI-compatible server with injected slow responses.')
+    parser.add_argument('-port', '--port', type=int, default=8000)
+    parser.add_argument('-replay_file', '--replay_llm_calls_file', default=None,
+                        help='Recording written with -record_file to serve responses from')
+    parser.add_argument('-latency', '--latency_seconds', type=float, default=0.5,
+                        help='Latency of every response')
+    parser.add_argument('-slow_fraction', '--slow_fraction', type=float, default=0.05,
+                        help='Fraction of requests that are stalled')
+    parser.add_argument('-slow_seconds', '--slow_seconds', type=float, default=30.0,
+                        help='Extra latency of a stalled request')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    if args.replay_llm_calls_file is not None:
+        MockCompletionHandler.records = load_recording(args.replay_llm_calls_file)
+    MockCompletionHandler.latency = args.latency_seconds
+    MockCompletionHandler.slow_fraction = args.slow_fraction
+    MockCompletionHandler.slow_seconds = args.slow_seconds
+
+    ThreadingHTTPServer(('localhost', args.port), MockCompletionHandler).serve_forever()
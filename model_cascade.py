@@ -0,0 +1,181 @@
+import re
+import json
+import time
+import logging
+import threading
+from llm_backends import create_backend
+from request_hedging import load_hedging, request_timeout
+from json_salvage import parse_json_objects
+
+
+# inclusion/exclusion are the primary extraction prompts, the others are the per-sentence follow-ups in process()
+prompt_types = ['inclusion', 'exclusion', 'time_frame', 'diseases', 'treatments']
+
+not_available_markers = ['na', 'n/a', 'not mentioned', 'not specified', 'not available', 'not found', 'not applicable']
+# whole words only, so that 'na' does not match inside "final" or "signature"
+not_available_pattern = re.compile(r'(?<![\w/])(?:{})(?![\w/])'.format('|'.join(re.escape(m) for m in not_available_markers)))
+
+
+def strip_list_marker(line):
+    return re.sub(r'^\s*(?:[-*•]|\d{1,2}[.)])\s*', '', line).strip()
+
+
+def json_blocks_valid(output, source_text=None):
+    # a cut-off response still passes when it has complete criteria, the rest is requested by a continuation
+    objects, _ = parse_json_objects(output)
+    return len(objects) > 0
+
+
+def time_frame_valid(output, source_text):
+    answer = output.strip().rstrip('.').strip()
+    if not_available_pattern.search(answer.lower()):
+        return True
+    return answer.lower() in source_text.lower()
+
+
+def spans_valid(output, source_text):
+    # every listed disease/treatment must be a span of the source sentence
+    source_lower = source_text.lower()
+    for line in output.split('\n'):
+        span = strip_list_marker(line).rstrip('.').strip()
+        if span == '' or '---' in span:
+            continue
+        if span.lower().startswith(('there are no', 'no ')) and 'mentioned' in span.lower():
+            continue
+        if span.lower() not in source_lower:
+            return False
+    return True
+
+
+validators = {
+    'inclusion': json_blocks_valid,
+    'exclusion': json_blocks_valid,
+    'time_frame': time_frame_valid,
+    'diseases': spans_valid,
+    'treatments': spans_valid,
+}
+
+
+class TierStats:
+    def __init__(self):
+        self.calls = 0
+        self.escalated_calls = 0
+        self.failed_validations = 0
+        self.latency = 0.0
+        self.tokens = 0
+
+
+class ModelCascade:
+    # Routes each prompt type to a model tier. When a cheaper tier's answer fails validation
+    # and an escalation tier is configured, the prompt is sent again to the escalation tier.
+    def __init__(self, tiers, routes, escalate_to=None, default_tier=None, hedger=None):
+        self.tiers = tiers
+        self.routes = routes
+        self.escalate_to = escalate_to
+        self.default_tier = default_tier or next(iter(tiers))
+        self.stats = {name: TierStats() for name in tiers}
+        # optional request_hedging.HedgedCaller enforcing per prompt type deadlines and sending hedges
+        self.hedger = hedger
+        # called with the tokens of answers that were paid for but not used (losing hedges)
+        self.token_listener = None
+        self._lock = threading.Lock()
+
+    def _call_tier(self, tier_name, prompt_text, escalated=False):
+        start = time.time()
+        output, total_tokens = self.tiers[tier_name]['backend'].complete(prompt_text)
+        elapsed = time.time() - start
+        with self._lock:
+            stats = self.stats[tier_name]
+            stats.calls += 1
+            stats.escalated_calls += int(escalated)
+            stats.latency += elapsed
+            stats.tokens += total_tokens
+        return output, total_tokens
+
+    def _discarded_tokens(self, total_tokens):
+        if self.token_listener is not None:
+            self.token_listener(total_tokens)
+
+    def _call(self, tier_name, prompt_text, prompt_type, validate, escalated=False):
+        if self.hedger is None:
+            return self._call_tier(tier_name, prompt_text, escalated)
+        return self.hedger.call(lambda: self._call_tier(tier_name, prompt_text, escalated), prompt_type,
+                                validate=validate, on_discarded=self._discarded_tokens)
+
+    def complete(self, prompt_text, prompt_type=None, source_text=None):
+        tier_name = self.routes.get(prompt_type, self.default_tier)
+        validator = validators.get(prompt_type)
+        validate = None
+        if validator is json_blocks_valid or (validator is not None and source_text is not None):
+            validate = lambda output: validator(output, source_text)
+
+        output, total_tokens = self._call(tier_name, prompt_text, prompt_type, validate)
+
+        if self.escalate_to is None or tier_name == self.escalate_to or validate is None:
+            return output, total_tokens
+        if validate(output):
+            return output, total_tokens
+
+        with self._lock:
+            self.stats[tier_name].failed_validations += 1
+        logging.info('Cascade: {} answer from tier {} failed validation, escalating to {}'.format(
+            prompt_type, tier_name, self.escalate_to))
+        escalated_output, escalated_tokens = self._call(self.escalate_to, prompt_text, prompt_type, validate, escalated=True)
+        return escalated_output, total_tokens + escalated_tokens
+
+    def report(self):
+        lines = []
+        for name, stats in self.stats.items():
+            cost = stats.tokens / 1000.0 * self.tiers[name].get('cost_per_1k_tokens', 0.0)
+            mean_latency = stats.latency / stats.calls if stats.calls else 0.0
+            lines.append('Tier {} ({}): {} calls ({} escalated), {} failed validations, mean latency {:.2f}s, '
+                         '{} tokens, cost ${:.4f}'.format(name, self.tiers[name]['model'], stats.calls,
+                                                         stats.escalated_calls, stats.failed_validations,
+                                                         mean_latency, stats.tokens, cost))
+        if self.hedger is not None:
+            lines.extend(self.hedger.report())
+        return lines
+
+
+def load_cascade(config_path=None, model_name='gpt-4', base_url=None, api_key=None, record_path=None, replay_path=None,
+                 hedge_config_path=None):
+    # Config file format (json):
+    # {
+    #   "tiers": {"fast": {"model": "gpt-3.5-turbo", "cost_per_1k_tokens": 0.002},
+    #             "gpt4": {"model": "gpt-4", "base_url": null, "cost_per_1k_tokens": 0.06}},
+    #   "routes": {"inclusion": "gpt4", "exclusion": "gpt4", "time_frame": "fast", "diseases": "fast", "treatments": "fast"},
+    #   "escalate_to": "gpt4"
+    # }
+    # Without a config file every prompt type goes to a single tier built from the command line options.
+    if config_path is None:
+        config = {'tiers': {'default': {'model': model_name, 'base_url': base_url}}, 'routes': {}}
+    else:
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+
+    hedger = None
+    timeout = None
+    if hedge_config_path is not None:
+        hedger = load_hedging(hedge_config_path)
+        timeout = request_timeout(hedge_config_path)
+
+    tiers = {}
+    for name, tier in config['tiers'].items():
+        tier = dict(tier)
+        tier['backend'] = create_backend(model_name=tier['model'], base_url=tier.get('base_url') or base_url,
+                                         api_key=tier.get('api_key') or api_key,
+                                         record_path=record_path, replay_path=replay_path,
+                                         request_timeout=timeout)
+        tiers[name] = tier
+
+    routes = config.get('routes', {})
+    for prompt_type, tier_name in routes.items():
+        if prompt_type not in prompt_types:
+            raise ValueError('Unknown prompt type in cascade config: {}'.format(prompt_type))
+        if tier_name not in tiers:
+            raise ValueError('Unknown tier in cascade config: {}'.format(tier_name))
+    escalate_to = config.get('escalate_to')
+    if escalate_to is not None and escalate_to not in tiers:
+        raise ValueError('Unknown escalation tier in cascade config: {}'.format(escalate_to))
+
+    return ModelCascade(tiers, routes, escalate_to=escalate_to, default_tier=config.get('default_tier'), hedger=hedger)
@@ -0,0 +1,164 @@
+import json
+import math
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class CallTimeoutError(TimeoutError):
+    pass
+
+
+class HedgedCaller:
+    # Runs each LLM call under a per prompt type deadline. When a call is still running after the
+    # configured latency percentile of recent calls of the same prompt type, a duplicate (hedge)
+    # is sent and the first valid answer wins. Hedges are capped at max_hedge_rate of all calls.
+    def __init__(self, timeouts=None, default_timeout=None, hedge_percentile=95, max_hedge_rate=0.05,
+                 min_samples=20, window=200, max_workers=16):
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm-call')
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_misses = 0
+        self.time_saved = 0.0
+
+    def hedge_delay(self, prompt_type):
+        with self._lock:
+            samples = sorted(self.latencies[prompt_type])
+        if len(samples) < self.min_samples:
+            return None
+        index = max(int(math.ceil(self.hedge_percentile / 100.0 * len(samples))) - 1, 0)
+        return samples[index]
+
+    def _timed(self, function, prompt_type):
+        start = time.time()
+        result = function()
+        end = time.time()
+        with self._lock:
+            self.latencies[prompt_type].append(end - start)
+        return result, end
+
+    def _reserve_hedge(self):
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_rate * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def _record_saved_time(self, primary, won_at):
+        def on_primary_done(future):
+            if future.exception() is None:
+                with self._lock:
+                    self.time_saved += max(future.result()[1] - won_at, 0.0)
+        primary.add_done_callback(on_primary_done)
+
+    def _discard(self, futures, on_discarded):
+        # answers that were not used still cost tokens
+        def on_done(future):
+            if on_discarded is not None and future.exception() is None:
+                on_discarded(future.result()[0][1])
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def call(self, function, prompt_type, validate=None, on_discarded=None):
+        # function() returns (output, total_tokens) like a backend's complete()
+        with self._lock:
+            self.calls += 1
+        timeout = self.timeouts.get(prompt_type, self.default_timeout)
+        start = time.time()
+        deadline = start + timeout if timeout else None
+        hedge_at = self.hedge_delay(prompt_type)
+        hedge_at = start + hedge_at if hedge_at is not None else None
+
+        primary = self.executor.submit(self._timed, function, prompt_type)
+        pending = {primary}
+        finished = []
+        fallback = None
+        last_error = None
+        hedge_sent = False
+
+        while True:
+            now = time.time()
+            wake_times = [t for t in (deadline, hedge_at if not hedge_sent else None) if t is not None]
+            wait_time = max(min(wake_times) - now, 0.0) if wake_times else None
+            done, pending = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    (output, total_tokens), _ = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if validate is None or validate(output):
+                    if future is not primary:
+                        with self._lock:
+                            self.hedge_wins += 1
+                        self._record_saved_time(primary, time.time())
+                    self._discard((pending | done | set(finished)) - {future}, on_discarded)
+                    return output, total_tokens
+                finished.append(future)
+                if fallback is None:
+                    fallback = (future, output, total_tokens)
+
+            now = time.time()
+            if not hedge_sent and hedge_at is not None and now >= hedge_at and primary in pending:
+                hedge_sent = True
+                if self._reserve_hedge():
+                    logging.info('Hedging: {} call still running after {:.1f}s, sending a duplicate'.format(
+                        prompt_type, now - start))
+                    pending.add(self.executor.submit(self._timed, function, prompt_type))
+
+            if not pending:
+                # nothing left to wait for: an invalid answer is still returned, the caller validates it again
+                if fallback is not None:
+                    future, output, total_tokens = fallback
+                    self._discard(set(finished) - {future}, on_discarded)
+                    return output, total_tokens
+                raise last_error
+
+            if deadline is not None and now >= deadline:
+                with self._lock:
+                    self.deadline_misses += 1
+                self._discard(pending | set(finished), on_discarded)
+                raise CallTimeoutError('{} call exceeded its {}s deadline'.format(prompt_type, timeout))
+
+    def report(self):
+        return ['Hedging: {} calls, {} hedges sent ({} won), {} deadline misses, {:.1f}s saved'.format(
+            self.calls, self.hedges, self.hedge_wins, self.deadline_misses, self.time_saved)]
+
+
+def load_hedging(config_path):
+    # Config file format (json), timeouts in seconds per prompt type:
+    # {
+    #   "timeouts": {"inclusion": 240, "exclusion": 240, "time_frame": 30, "diseases": 30, "treatments": 30},
+    #   "default_timeout": 120,
+    #   "hedge_percentile": 95,
+    #   "max_hedge_rate": 0.05,
+    #   "min_samples": 20
+    # }
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    return HedgedCaller(timeouts=config.get('timeouts'), default_timeout=config.get('default_timeout'),
+                        hedge_percentile=config.get('hedge_percentile', 95),
+                        max_hedge_rate=config.get('max_hedge_rate', 0.05),
+                        min_samples=config.get('min_samples', 20),
+                        max_workers=config.get('max_workers', 16))
+
+
+def request_timeout(config_path):
+    # the longest deadline, used as the HTTP timeout so that abandoned calls do not hold a worker thread forever
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    deadlines = list((config.get('timeouts') or {}).values()) + [config.get('default_timeout')]
+    deadlines = [d for d in deadlines if d is not None]
+    return max(deadlines) if deadlines else None
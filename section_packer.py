@@ -0,0 +1,96 @@
+import re
+import logging
+
+
+encoding = None
+
+nct_id_pattern = re.compile(r'NCT\d{8}', re.I)
+
+
+def count_tokens(text):
+    global encoding
+    if encoding is None:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding('cl100k_base')
+    return len(encoding.encode(text))
+
+
+def section_header(trial_id):
+    return '[Trial {}]'.format(trial_id)
+
+
+def pack_sections(sections):
+    # sections: list of (trial_id, criteria_text), all of the same criteria type
+    return '\n\n'.join(section_header(trial_id) + '\n' + text.strip() for trial_id, text in sections)
+
+
+class SectionPacker:
+    # Collects short inclusion/exclusion sections from different trials so that several of them
+    # share one extraction prompt. A batch is closed as soon as the next section would push the
+    # request (instruction preamble + tagged sections) over max_tokens.
+    def __init__(self, max_tokens, preamble_tokens, max_section_words=100):
+        self.max_tokens = max_tokens
+        self.preamble_tokens = preamble_tokens
+        self.max_section_words = max_section_words
+        self.pending = {'in': [], 'ex': []}
+        self.pending_tokens = {'in': 0, 'ex': 0}
+
+    def accepts(self, n_words):
+        return n_words <= self.max_section_words
+
+    def _close(self, item):
+        batch = {'item': item, 'sections': self.pending[item]}
+        self.pending[item] = []
+        self.pending_tokens[item] = 0
+        return batch
+
+    def add(self, item, trial_id, text):
+        # returns the batch that was closed to make room for this section, or None
+        section_tokens = count_tokens(section_header(trial_id) + '\n' + text.strip() + '\n\n')
+        closed_batch = None
+        if self.pending[item] and self.preamble_tokens[item] + self.pending_tokens[item] + section_tokens > self.max_tokens:
+            closed_batch = self._close(item)
+        self.pending[item].append((trial_id, text))
+        self.pending_tokens[item] += section_tokens
+        return closed_batch
+
+    def flush(self):
+        return [self._close(item) for item in self.pending if self.pending[item]]
+
+
+def find_trial(extracted_criteria, sections):
+    trial_ids = [trial_id for trial_id, _ in sections]
+    tag = str(extracted_criteria.get('Trial ID', '')).strip().strip('[]').strip()
+    if tag.lower().startswith('trial '):
+        tag = tag[len('trial '):].strip()
+    if tag in trial_ids:
+        return tag
+    match = nct_id_pattern.search(tag)
+    if match and match.group(0).upper() in trial_ids:
+        return match.group(0).upper()
+
+    # no usable tag, fall back to the section that contains the source sentence
+    sentence = str(extracted_criteria.get('Sentence', '')).strip().lower()
+    if sentence:
+        candidates = [trial_id for trial_id, text in sections if sentence in text.lower()]
+        if len(candidates) == 1:
+            return candidates[0]
+    return None
+
+
+def demultiplex(message, sections):
+    # splits the extracted criteria objects of a packed response back into per-trial lists
+    by_trial = {trial_id: [] for trial_id, _ in sections}
+    for extracted_criteria in message:
+        if not isinstance(extracted_criteria, dict):
+            continue
+        trial_id = find_trial(extracted_criteria, sections)
+        if trial_id is None:
+            logging.warning('Packed response: could not assign criteria to a trial -- Sentence: {}'.format(
+                extracted_criteria.get('Sentence')))
+            continue
+        extracted_criteria = dict(extracted_criteria)
+        extracted_criteria.pop('Trial ID', None)
+        by_trial[trial_id].append(extracted_criteria)
+    return by_trial
@@ -0,0 +1,15 @@
+import sqlite3
+import contextlib
+
+
+@contextlib.contextmanager
+def connect(db_path):
+    # One short-lived connection per operation, so the sidecar files can be used from several threads and
+    # processes. Autocommit mode: writers open their own transaction with BEGIN IMMEDIATE, which takes the
+    # write lock up front, and closing a connection with an open transaction rolls it back.
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
@@ -0,0 +1,69 @@
+import queue
+import logging
+import threading
+
+
+end_of_stream = object()
+
+
+class Stage:
+    # function takes one item and returns an iterable of items for the next stage
+    # (a list, a generator, or an empty list to drop the item)
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+def _feed(source, output_queue):
+    try:
+        for item in source:
+            output_queue.put(item)
+    except Exception:
+        logging.exception('Pipeline: source failed')
+    finally:
+        output_queue.put(end_of_stream)
+
+
+def _work(stage, input_queue, output_queue, remaining_workers, lock):
+    while True:
+        item = input_queue.get()
+        if item is end_of_stream:
+            # let the sibling workers see the end of stream too; the last one closes the next queue
+            input_queue.put(end_of_stream)
+            with lock:
+                remaining_workers[stage.name] -= 1
+                last_worker = remaining_workers[stage.name] == 0
+            if last_worker and output_queue is not None:
+                output_queue.put(end_of_stream)
+            return
+        try:
+            for output in stage.function(item) or []:
+                if output_queue is not None:
+                    output_queue.put(output)
+        except Exception:
+            logging.exception('Pipeline: stage {} failed on an item, skipping it'.format(stage.name))
+
+
+def run_pipeline(source, stages, queue_size=8):
+    # Runs the stages in worker threads connected by bounded queues. A full queue blocks the
+    # stage in front of it, so the source is only consumed as fast as the slowest stage can
+    # keep up and the number of items in flight never exceeds roughly
+    # (number of stages + workers) * queue_size, whatever the size of the corpus.
+    # The output of the last stage is discarded, so it should be the sink.
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    remaining_workers = {stage.name: stage.workers for stage in stages}
+    lock = threading.Lock()
+
+    threads = [threading.Thread(target=_feed, args=(source, queues[0]), name='pipeline-source', daemon=True)]
+    for i, stage in enumerate(stages):
+        output_queue = queues[i + 1] if i + 1 < len(queues) else None
+        for n in range(stage.workers):
+            threads.append(threading.Thread(target=_work, args=(stage, queues[i], output_queue, remaining_workers, lock),
+                                            name='pipeline-{}-{}'.format(stage.name, n), daemon=True))
+    for thread in threads:
+        thread.start()
+    # join with a timeout so that Ctrl-C still reaches the main thread (the workers are daemon threads)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
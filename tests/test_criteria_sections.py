@@ -0,0 +1,49 @@
+import pytest
+from criteria_sections import segment_criteria, segment_batch, criteria_texts
+
+
+def headings(text):
+    return [(section['kind'], section['heading']) for section in segment_criteria(text)]
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('Inclusion Criteria:\n- Age >= 18\nExclusion Criteria:\n- Pregnancy',
+     [('in', 'Inclusion Criteria:'), ('ex', 'Exclusion Criteria:')]),
+    ('INCLUSION CRITERIA\n- Age >= 18\nEXCLUSION CRITERIA\n- Pregnancy',
+     [('in', 'INCLUSION CRITERIA'), ('ex', 'EXCLUSION CRITERIA')]),
+    ('  Key Inclusion Criteria:\n- Age >= 18\n  Key Exclusion Criteria:\n- Pregnancy',
+     [('in', 'Key Inclusion Criteria:'), ('ex', 'Key Exclusion Criteria:')]),
+    ('Inclusion criteria for Part B:\n- Age >= 18', [('in', 'Inclusion criteria for Part B:')]),
+    ('Adults with NASH. Inclusion criteria: age >= 18. Exclusion criteria: pregnancy.',
+     [('in', 'Inclusion criteria:'), ('ex', 'Exclusion criteria:')]),
+    ('Adults with NASH. Key exclusion criteria: pregnancy.', [('ex', 'Key exclusion criteria:')]),
+])
+def test_heading_variants(text, expected):
+    assert headings(text) == expected
+
+
+@pytest.mark.parametrize('text', [
+    'Inclusion Criteria:\n- Age >= 18\n- Patients not meeting exclusion criteria: see below',
+    'Inclusion Criteria:\n- Age >= 18\n- Meets all inclusion criteria of the main study',
+    'Inclusion Criteria:\n- Age >= 18, and no exclusion criteria: pregnancy, HIV',
+    'Inclusion Criteria:\n- Age >= 18\n2.Exclusion criteria: of the parent study apply',
+])
+def test_mentions_are_not_headings(text):
+    assert headings(text) == [('in', 'Inclusion Criteria:')]
+
+
+def test_section_texts_and_offsets():
+    text = 'Intro\nInclusion Criteria:\n - Age >= 18\n -\nExclusion Criteria:\n - Pregnancy'
+    inclusion, exclusion = segment_criteria(text)
+    assert inclusion['text'] == '- Age >= 18'
+    assert exclusion['text'] == '- Pregnancy'
+    assert text[inclusion['heading_start']:inclusion['start']] == 'Inclusion Criteria:'
+    assert criteria_texts([inclusion, exclusion]) == ('- Age >= 18', '- Pregnancy')
+
+
+def test_batch_keeps_the_texts_apart():
+    texts = ['Inclusion Criteria:\n- Age >= 18', 'No headings here', 'Exclusion Criteria:\n- Pregnancy']
+    results = segment_batch(texts)
+    assert [[s['kind'] for s in sections] for sections in results] == [['in'], [], ['ex']]
+    assert results[0][0]['text'] == '- Age >= 18'
+    assert results[2][0]['heading_start'] == 0
@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy_modules = ['pandas', 'langchain', 'nltk', 'bs4', 'tqdm', 'tiktoken']
+
+# generous for a cold start on a slow machine; the deferred imports take several seconds when they regress
+import_budget_seconds = 1.0
+
+
+def import_entry_points():
+    code = ('import sys, json, eligibility_criteria_extraction, worker; '
+            'print(json.dumps([m for m in {} if m in sys.modules]))'.format(heavy_modules))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=repo_dir,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout), result.stderr
+
+
+def top_level_import_seconds(importtime_output, modules):
+    # "import time: self [us] | cumulative | imported package", nested imports are indented
+    total = 0
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if name.strip() in modules and not name.startswith('  '):
+            total += int(cumulative)
+    return total / 1e6
+
+
+def test_entry_points_defer_heavy_imports():
+    loaded, _ = import_entry_points()
+    assert loaded == []
+
+
+def test_entry_points_import_within_budget():
+    _, importtime_output = import_entry_points()
+    seconds = top_level_import_seconds(importtime_output, ['eligibility_criteria_extraction', 'worker'])
+    assert 0 < seconds < import_budget_seconds
@@ -0,0 +1,73 @@
+import json
+from json_salvage import parse_json_objects, unprocessed_text, split_sentences, _complete
+
+
+def criterion(sentence, entity='Disease', attribute='Diagnosis'):
+    return {'Entity': entity, 'Attribute': attribute, 'Value': 'Yes', 'Condition': 'NA', 'Sentence': sentence}
+
+
+def test_complete_list_is_parsed_and_not_truncated():
+    criteria = [criterion('Age >= 18 years', 'Demographic', 'Age'), criterion('Known HIV infection')]
+    objects, truncated = parse_json_objects('```json\n' + json.dumps(criteria) + '\n```')
+    assert objects == criteria
+    assert not truncated
+
+
+def test_cut_off_list_keeps_its_complete_objects():
+    criteria = [criterion('Age >= 18 years', 'Demographic', 'Age'), criterion('Known HIV infection')]
+    output = '```json\n' + json.dumps(criteria) + '\n```'
+    # the output limit was hit inside the third object
+    output = output[:output.rindex(']')] + ', {"Entity": "Lab", "Attribute": "AL'
+    objects, truncated = parse_json_objects(output)
+    assert objects == criteria
+    assert truncated
+
+
+def test_trailing_commas_are_repaired():
+    output = ('```json\n[{"Entity": "Disease", "Attribute": "Diagnosis", "Value": "Yes", "Condition": "NA", '
+              '"Sentence": "Known HIV infection",},]\n```')
+    objects, truncated = parse_json_objects(output)
+    assert objects == [criterion('Known HIV infection')]
+    assert not truncated
+
+
+def test_one_malformed_block_does_not_discard_the_others():
+    output = ('```json\n[{"Entity": "Disease" "Attribute": "Diagnosis"}]\n```\n'
+              '```json\n' + json.dumps([criterion('Known HIV infection')]) + '\n```')
+    objects, _ = parse_json_objects(output)
+    assert objects == [criterion('Known HIV infection')]
+
+
+def test_complete_fills_missing_keys_and_converts_values():
+    assert _complete({'Entity': 'Lab', 'Attribute': 'ALT', 'Value': 3}) == [
+        {'Entity': 'Lab', 'Attribute': 'ALT', 'Value': '3', 'Condition': 'NA', 'Sentence': 'NA'}]
+
+
+def test_complete_drops_objects_without_entity_or_attribute():
+    assert _complete({'Entity': 'Lab', 'Value': 'Yes'}) == []
+    assert _complete({'Entity': ' ', 'Attribute': 'ALT'}) == []
+    assert _complete({'Entity': None, 'Attribute': 'ALT'}) == []
+
+
+def test_split_sentences_splits_lines_and_sentence_ends_but_not_list_numbers():
+    text = '1. Age >= 18 years. Signed consent\n2. Known HIV infection'
+    assert split_sentences(text) == ['1. Age >= 18 years.', 'Signed consent', '2. Known HIV infection']
+
+
+def test_unprocessed_text_continues_a_bullet_list_without_periods():
+    source_text = '-  Age >= 18 years\n\n -  Known HIV infection\n\n -  ALT < 3x ULN\n\n -  BMI < 40'
+    objects = [criterion('Age >= 18 years', 'Demographic', 'Age'), criterion('Known HIV infection')]
+    assert unprocessed_text(source_text, objects) == '-  ALT < 3x ULN\n\n -  BMI < 40'
+
+
+def test_unprocessed_text_continues_after_numbered_sentences():
+    source_text = '1. Age >= 18 years. 2. Known HIV infection. 3. ALT < 3x ULN.'
+    objects = [criterion('1. Age >= 18 years', 'Demographic', 'Age')]
+    assert unprocessed_text(source_text, objects) == '2. Known HIV infection. 3. ALT < 3x ULN.'
+
+
+def test_unprocessed_text_is_none_when_nothing_is_left_or_nothing_matched():
+    source_text = '-  Age >= 18 years\n -  Known HIV infection'
+    assert unprocessed_text(source_text, [criterion('Known HIV infection')]) is None
+    assert unprocessed_text(source_text, [criterion('Pregnancy')]) is None
+    assert unprocessed_text(source_text, [criterion('NA')]) is None
@@ -0,0 +1,158 @@
+import os
+import re
+import sys
+import json
+import subprocess
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('bs4')
+pytest.importorskip('langchain')
+nltk = pytest.importorskip('nltk')
+
+import eligibility_criteria_extraction as extraction
+from trial_discovery import discover_trials
+from trial_scheduler import TrialQueue, schedule_trials, load_priority_spec
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(tests_dir)
+
+trial_template = """<?xml version="1.0" encoding="UTF-8"?>
+<clinical_study>
+  <required_header><url>https://clinicaltrials.gov/show/{nct_id}</url></required_header>
+  <id_info><nct_id>{nct_id}</nct_id></id_info>
+  <phase>Phase {phase}</phase>
+  <eligibility>
+    <criteria>
+      <textblock>
+        Inclusion Criteria:
+
+          -  Age 18 to {max_age} years
+          -  Histologic evidence of NASH with fibrosis stage F{stage}
+          -  BMI between 25 and {bmi} kg/m2{extra_inclusion}
+
+        Exclusion Criteria:
+
+          -  Prior treatment with pioglitazone within {months} months
+          -  History of liver transplant
+          -  Active hepatitis B or C infection
+      </textblock>
+    </criteria>
+    <gender>All</gender>
+    <minimum_age>18 Years</minimum_age>
+    <maximum_age>{max_age} Years</maximum_age>
+  </eligibility>
+</clinical_study>
+"""
+
+
+def write_trials(directory, n_trials):
+    for i in range(n_trials):
+        nct_id = 'NCT{:08d}'.format(i)
+        # every tenth trial has an inclusion section long enough to be chunked
+        extra = ''.join('\n          -  Stable dose of medication {} for at least {} weeks'.format(n, i % 12 + 1)
+                        for n in range(25)) if i % 10 == 0 else ''
+        with open(os.path.join(directory, nct_id + '.xml'), 'w') as f:
+            f.write(trial_template.format(nct_id=nct_id, phase=i % 3 + 1, max_age=60 + i % 20, stage=i % 3 + 1,
+                                          bmi=40 + i % 5, months=i % 12 + 1, extra_inclusion=extra))
+
+
+class StubCascade:
+    # answers every extraction prompt with one criterion per bullet of the criteria text, without any llm
+    tokens_per_call = 100
+
+    def complete(self, prompt_text, prompt_type=None, source_text=None):
+        if prompt_type not in ('inclusion', 'exclusion'):
+            return 'NA', self.tokens_per_call
+        criteria = []
+        for line in (source_text or '').split('\n'):
+            line = re.sub(r'^\s*-\s*', '', line).strip()
+            if line:
+                entity = 'Demographic' if line.startswith('Age') else 'Disease'
+                criteria.append({'Entity': entity, 'Attribute': line.split(' ')[0], 'Value': 'Yes',
+                                 'Condition': 'NA', 'Sentence': line})
+        return '```json\n' + json.dumps(criteria) + '\n```', self.tokens_per_call
+
+    def report(self):
+        return []
+
+
+def run_streaming_trials(input_dir, output_file, queue_file=None, max_tokens=None):
+    extraction.llm_cascade = StubCascade()
+    extraction.token_budget.max_tokens = max_tokens
+    extraction.token_budget.spent = 0
+    if queue_file is None:
+        trial_queue = None
+        source = ({'file': filename} for filename in discover_trials(input_dir))
+    else:
+        trial_queue = TrialQueue(queue_file)
+        source = schedule_trials(list(discover_trials(input_dir)), trial_queue, load_priority_spec(),
+                                 extraction.token_budget)
+    extraction.run_streaming(source, output_file, trial_queue, 1, 0, extraction.max_tokens, extraction.chunk_size,
+                             extract_workers=4, queue_size=8)
+    return trial_queue
+
+
+def written_trial_ids(output_file):
+    with open(output_file, 'r') as f:
+        return set(json.loads(line)['Trial ID'] for line in f if line.strip())
+
+
+def max_rss_of_run(input_dir, output_file):
+    code = ('import resource, test_streaming_extraction as t; t.run_streaming_trials({!r}, {!r}); '
+            'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'.format(input_dir, output_file))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir, tests_dir] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    result = subprocess.run([sys.executable, '-c', code], cwd=repo_dir, env=env, capture_output=True, text=True,
+                            check=True)
+    return int(result.stdout.split()[-1])
+
+
+@pytest.fixture(autouse=True)
+def require_tokenizer():
+    try:
+        nltk.word_tokenize('Age 18 years')
+    except LookupError:
+        pytest.skip('nltk punkt tokenizer data is not installed')
+
+
+def test_streaming_writes_every_trial(tmp_path):
+    input_dir = tmp_path / 'trials'
+    input_dir.mkdir()
+    write_trials(str(input_dir), 50)
+    output_file = str(tmp_path / 'out.jsonl')
+    run_streaming_trials(str(input_dir), output_file)
+    assert written_trial_ids(output_file) == set('NCT{:08d}'.format(i) for i in range(50))
+
+
+def test_streaming_stops_at_token_budget_and_marks_written_trials_done(tmp_path):
+    input_dir = tmp_path / 'trials'
+    input_dir.mkdir()
+    write_trials(str(input_dir), 300)
+    output_file = str(tmp_path / 'out.jsonl')
+    queue_file = str(tmp_path / 'queue.json')
+    # a few trials' worth of tokens; the trials already in flight are finished
+    trial_queue = run_streaming_trials(str(input_dir), output_file, queue_file=queue_file, max_tokens=1000)
+    written = written_trial_ids(output_file)
+    assert 0 < len(written) < 300
+    assert trial_queue.completed == written
+    assert len(trial_queue) == 300 - len(written)
+
+    # the next run resumes with exactly the trials that were not written
+    resumed = TrialQueue(queue_file)
+    resumed.load()
+    assert set(s['trial_id'] for s in resumed.pending) == set('NCT{:08d}'.format(i) for i in range(300)) - written
+
+
+@pytest.mark.slow
+def test_streaming_memory_stays_flat_with_corpus_size(tmp_path):
+    rss = {}
+    for n_trials in (500, 5000):
+        input_dir = tmp_path / 'trials_{}'.format(n_trials)
+        input_dir.mkdir()
+        write_trials(str(input_dir), n_trials)
+        output_file = str(tmp_path / 'out_{}.jsonl'.format(n_trials))
+        rss[n_trials] = max_rss_of_run(str(input_dir), output_file)
+        assert len(written_trial_ids(output_file)) == n_trials
+    # ru_maxrss is in kB on Linux; 10x the trials may not need more than the trials in flight
+    assert rss[5000] < rss[500] * 1.1 + 20 * 1024, rss
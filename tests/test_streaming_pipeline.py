@@ -0,0 +1,74 @@
+import tracemalloc
+import pytest
+from streaming_pipeline import Stage, run_pipeline
+
+
+def parse_stage(item):
+    # stands in for read_trial: every trial carries a few kB of criteria text
+    return [{'id': item, 'text': 'criteria text {} '.format(item) * 200}]
+
+
+def chunk_stage(job):
+    text = job.pop('text')
+    job['chunks'] = [text[i:i + 500] for i in range(0, len(text), 500)]
+    return [job]
+
+
+def extract_stage(job):
+    job['rows'] = [{'Attribute': chunk[:20], 'Value': 'Yes'} for chunk in job.pop('chunks')]
+    return [job]
+
+
+def make_write_stage(written):
+    def write_stage(job):
+        written.append(job['id'])
+        return []
+    return write_stage
+
+
+def peak_memory(n_items):
+    # the sink only counts, keeping the written trial IDs would itself grow with the corpus
+    written = [0]
+
+    def count_stage(job):
+        written[0] += 1
+        return []
+
+    stages = [Stage('parse', parse_stage), Stage('chunk', chunk_stage),
+              Stage('extract', extract_stage, workers=4), Stage('write', count_stage)]
+    tracemalloc.start()
+    try:
+        # the source is a generator, so the pipeline can only hold what is in flight
+        run_pipeline((i for i in range(n_items)), stages, queue_size=8)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert written[0] == n_items
+    return peak
+
+
+def test_every_item_reaches_the_sink():
+    written = []
+    run_pipeline(iter(range(1000)), [Stage('parse', parse_stage), Stage('chunk', chunk_stage),
+                                     Stage('extract', extract_stage, workers=3), Stage('write', make_write_stage(written))])
+    assert sorted(written) == list(range(1000))
+
+
+def test_failing_item_is_skipped():
+    written = []
+
+    def flaky_stage(item):
+        if item == 3:
+            raise ValueError('bad trial')
+        return [{'id': item}]
+
+    run_pipeline(iter(range(10)), [Stage('flaky', flaky_stage), Stage('write', make_write_stage(written))])
+    assert sorted(written) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+
+
+@pytest.mark.slow
+def test_memory_stays_flat_with_corpus_size():
+    # 10x the trials must not need noticeably more memory than the items in flight
+    peak_small = peak_memory(10000)
+    peak_large = peak_memory(100000)
+    assert peak_large < peak_small * 1.5 + 1024 * 1024, (peak_small, peak_large)
@@ -0,0 +1,92 @@
+import os
+import pytest
+from trial_discovery import discover_trials, shard_name
+from trial_index import TrialIndex, parse_where, where_matches, read_trial_fields
+
+trial_template = """<?xml version="1.0" encoding="UTF-8"?>
+<clinical_study>
+  <id_info><nct_id>{nct_id}</nct_id></id_info>
+  <overall_status>{status}</overall_status>
+  <start_date>{start_date}</start_date>
+  <phase>{phase}</phase>
+  <study_type>{study_type}</study_type>
+{conditions}
+</clinical_study>
+"""
+
+statuses = ['Recruiting', 'Completed', 'Terminated', 'Active, not recruiting']
+phases = ['Phase 1', 'Phase 2', 'Phase 2/Phase 3', 'Phase 3', 'N/A']
+conditions = ['Nonalcoholic Steatohepatitis', 'Type 2 Diabetes', 'Obesity', 'NAFLD']
+
+
+def write_trial(directory, i):
+    nct_id = 'NCT{:08d}'.format(i * 7919)
+    # trials without a start date or condition check that a missing field never matches
+    start_date = '' if i % 11 == 0 else 'January {}, {}'.format(i % 28 + 1, 2005 + i % 15)
+    trial_conditions = '' if i % 13 == 0 else '\n'.join(
+        '  <condition>{}</condition>'.format(conditions[(i + n) % len(conditions)]) for n in range(i % 3 + 1))
+    filename = os.path.join(directory, nct_id + '.xml')
+    with open(filename, 'w') as f:
+        f.write(trial_template.format(nct_id=nct_id, status=statuses[i % len(statuses)], start_date=start_date,
+                                      phase=phases[i % len(phases)],
+                                      study_type='Interventional' if i % 4 else 'Observational',
+                                      conditions=trial_conditions))
+    return filename
+
+
+@pytest.fixture
+def trial_files(tmp_path):
+    directory = tmp_path / 'trials'
+    directory.mkdir()
+    return [write_trial(str(directory), i) for i in range(120)]
+
+
+@pytest.mark.parametrize('where', [
+    'phase in (2, 2/3) and overall_status = Recruiting',
+    'study_type = interventional and condition ~ steatohepatitis',
+    'condition != obesity',
+    'condition not in (nafld, "type 2 diabetes")',
+    'start_date >= 2015 and phase != n/a',
+    'start_date < "June 2010"',
+    'overall_status in ("active, not recruiting", terminated) and start_date <= 2012-06-30',
+])
+def test_index_selects_the_same_trials_as_the_file_scan(tmp_path, trial_files, where):
+    clauses = parse_where(where)
+    trial_index = TrialIndex(str(tmp_path / 'index.sqlite'))
+    trial_index.build(trial_files)
+    scanned = sorted(trial['nct_id'] for trial in map(read_trial_fields, trial_files) if where_matches(clauses, trial))
+    assert [nct_id for nct_id, _ in trial_index.select(clauses)] == scanned
+    assert scanned
+
+
+@pytest.mark.parametrize('where', [
+    'study_type = interventional and',
+    'study_type = interventional and ',
+    'phase = 2 or phase = 3',
+    'phase in 2',
+    'sponsor = nih',
+])
+def test_invalid_where_expressions_are_rejected(where):
+    with pytest.raises(ValueError):
+        parse_where(where)
+
+
+def test_moving_a_trial_into_its_shard_keeps_it_indexed(tmp_path):
+    input_dir = tmp_path / 'trials'
+    input_dir.mkdir()
+    flat_file = write_trial(str(input_dir), 1)
+    trial_index = TrialIndex(str(tmp_path / 'index.sqlite'))
+    trial_index.build(list(discover_trials(str(input_dir))))
+    assert len(trial_index) == 1
+
+    nct_id = os.path.splitext(os.path.basename(flat_file))[0]
+    shard_dir = input_dir / shard_name(nct_id)
+    shard_dir.mkdir()
+    os.rename(flat_file, str(shard_dir / (nct_id + '.xml')))
+    trial_index.build(list(discover_trials(str(input_dir))))
+    assert trial_index.select(parse_where('condition ~ diabetes')) == [(nct_id, str(shard_dir / (nct_id + '.xml')))]
+    assert len(trial_index) == 1
+
+    os.remove(str(shard_dir / (nct_id + '.xml')))
+    trial_index.build(list(discover_trials(str(input_dir))))
+    assert len(trial_index) == 0
@@ -0,0 +1,53 @@
+import time
+import multiprocessing
+from work_queue import WorkQueue
+
+n_trials = 60
+lease_seconds = 2
+
+
+def run_worker(db_path, worker_id, completed):
+    work_queue = WorkQueue(db_path, lease_seconds=lease_seconds)
+    while True:
+        claimed = work_queue.claim_next(worker_id, poll_seconds=0.5)
+        if claimed is None:
+            break
+        time.sleep(0.01)
+        if work_queue.complete(worker_id, claimed['trial_id'], [{'Trial ID': claimed['trial_id']}]):
+            completed.put(claimed['trial_id'])
+
+
+def test_workers_complete_every_trial_once_and_reclaim_abandoned_leases(tmp_path):
+    db_path = str(tmp_path / 'queue.sqlite')
+    work_queue = WorkQueue(db_path, lease_seconds=lease_seconds)
+    trial_ids = ['NCT{:08d}'.format(i) for i in range(n_trials)]
+    work_queue.enqueue([{'trial_id': trial_id, 'file': trial_id + '.xml'} for trial_id in trial_ids])
+    # a worker that crashed right after claiming: its lease is never renewed or released
+    abandoned = work_queue.claim('crashed-worker')
+
+    completed = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_worker, args=(db_path, 'worker-{}'.format(i), completed))
+               for i in range(4)]
+    for worker in workers:
+        worker.start()
+    completed_ids = [completed.get(timeout=60) for _ in trial_ids]
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    # no trial was completed a second time
+    assert completed.empty()
+    assert sorted(completed_ids) == trial_ids
+    assert abandoned['trial_id'] in completed_ids
+    assert work_queue.counts() == {'done': n_trials}
+    assert sorted(trial_id for trial_id, _ in work_queue.results()) == trial_ids
+
+
+def test_released_trial_fails_after_max_attempts(tmp_path):
+    work_queue = WorkQueue(str(tmp_path / 'queue.sqlite'), max_attempts=2)
+    work_queue.enqueue([{'trial_id': 'NCT00000001', 'file': 'NCT00000001.xml'}])
+    for _ in range(2):
+        claimed = work_queue.claim('worker')
+        work_queue.release('worker', claimed['trial_id'])
+    assert work_queue.claim('worker') is None
+    assert work_queue.counts() == {'failed': 1}
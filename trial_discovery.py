@@ -0,0 +1,87 @@
+import os
+import re
+
+
+nct_id_pattern = re.compile(r'^NCT\d{8}$')
+shard_pattern = re.compile(r'^NCT\d{4}xxxx$')
+
+
+def shard_name(trial_id):
+    # the ClinicalTrials.gov dump shards trials by ID prefix: NCT01234567 -> NCT0123xxxx/
+    return trial_id[:7] + 'xxxx'
+
+
+def load_manifest(manifest_file):
+    # one NCT ID per line; blank lines and '#' comments are ignored
+    trial_ids = set()
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                trial_ids.add(line.upper())
+    return trial_ids
+
+
+def parse_id_range(id_range):
+    # "NCT00000100-NCT00099999" -> ('NCT00000100', 'NCT00099999'), both ends inclusive
+    start, end = [part.strip().upper() for part in id_range.split('-')]
+    if not nct_id_pattern.match(start) or not nct_id_pattern.match(end):
+        raise ValueError('Invalid NCT ID range: {}'.format(id_range))
+    return start, end
+
+
+def _sorted_entries(directory):
+    with os.scandir(directory) as entries:
+        entries = list(entries)
+    entries.sort(key=lambda entry: entry.name)
+    return entries
+
+
+def iter_xml_files(directory, sort=True, include_dir=None, include_file=None):
+    # Walks the directory tree lazily with os.scandir. Only one directory listing is held at a
+    # time, and sorting each listing by name gives NCT ID order across the sharded layout.
+    # include_dir/include_file filter on entry names before descending or yielding.
+    if sort:
+        entries = _sorted_entries(directory)
+    else:
+        entries = os.scandir(directory)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if include_dir is None or include_dir(entry.name):
+                yield from iter_xml_files(entry.path, sort, include_dir, include_file)
+        elif entry.name.endswith('.xml'):
+            if include_file is None or include_file(entry.name[:-len('.xml')]):
+                yield entry.path
+
+
+def discover_trials(input_dir, trial_ids=None, id_range=None, sort=True):
+    # Yields the xml paths of the trials in input_dir (flat or sharded into NCTxxxxxxxx/ directories).
+    # With trial_ids the files are looked up directly in their shard directory, without a scan; with
+    # id_range only the shard directories overlapping the range are listed.
+    if input_dir is None:
+        # os.scandir(None) would list the working directory
+        raise ValueError('No input directory given')
+    if trial_ids is not None:
+        for trial_id in sorted(trial_ids) if sort else trial_ids:
+            for candidate in (os.path.join(input_dir, shard_name(trial_id), trial_id + '.xml'),
+                              os.path.join(input_dir, trial_id + '.xml')):
+                if os.path.isfile(candidate):
+                    yield candidate
+                    break
+        return
+
+    if id_range is not None:
+        start, end = id_range
+        first_shard, last_shard = shard_name(start), shard_name(end)
+
+        def include_dir(name):
+            # directories that are not shards (e.g. the top level of the dump) are always searched
+            return not shard_pattern.match(name) or first_shard <= name <= last_shard
+
+        def include_file(name):
+            return start <= name.upper() <= end
+
+        yield from iter_xml_files(input_dir, sort, include_dir, include_file)
+        return
+
+    yield from iter_xml_files(input_dir, sort)
@@ -0,0 +1,238 @@
+import os
+import re
+import time
+import logging
+from trial_scheduler import normalize_phase
+from sqlite_util import connect
+
+
+# structured fields that -where can filter on
+fields = ['nct_id', 'phase', 'overall_status', 'condition', 'study_type', 'start_date']
+
+field_patterns = {field: re.compile(r'<{0}(?:\s[^>]*)?>\s*(.*?)\s*</{0}>'.format(field), re.S)
+                  for field in fields}
+
+months = {name: i + 1 for i, name in enumerate(['january', 'february', 'march', 'april', 'may', 'june', 'july',
+                                                'august', 'september', 'october', 'november', 'december'])}
+
+clause_pattern = re.compile(r'\s*(\w+)\s*(!=|<=|>=|=|<|>|~|not\s+in\b|in\b)\s*'
+                            r'(\([^)]*\)|"[^"]*"|\'[^\']*\'|[^\s()]+)\s*(and\b|$)', re.I)
+
+schema = """
+CREATE TABLE IF NOT EXISTS trials (
+    nct_id TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    phase TEXT,
+    overall_status TEXT,
+    study_type TEXT,
+    start_date TEXT
+);
+CREATE INDEX IF NOT EXISTS trials_phase ON trials (phase);
+CREATE INDEX IF NOT EXISTS trials_overall_status ON trials (overall_status);
+CREATE INDEX IF NOT EXISTS trials_study_type ON trials (study_type);
+CREATE INDEX IF NOT EXISTS trials_start_date ON trials (start_date);
+CREATE TABLE IF NOT EXISTS conditions (
+    nct_id TEXT NOT NULL,
+    condition TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conditions_nct_id ON conditions (nct_id);
+CREATE INDEX IF NOT EXISTS conditions_condition ON conditions (condition);
+"""
+
+
+def normalize_date(date_text):
+    # "January 15, 2010" -> "2010-01-15", "January 2010" -> "2010-01"; ISO dates and years are kept,
+    # so ISO prefixes compare correctly as strings
+    date_text = date_text.strip().lower()
+    match = re.match(r'^([a-z]+)\s+(?:(\d{1,2}),\s*)?(\d{4})$', date_text)
+    if match and match.group(1) in months:
+        date = '{}-{:02d}'.format(match.group(3), months[match.group(1)])
+        if match.group(2):
+            date += '-{:02d}'.format(int(match.group(2)))
+        return date
+    return date_text
+
+
+def normalize_value(field, value):
+    value = value.strip()
+    if field == 'phase':
+        return normalize_phase(value)
+    if field == 'start_date':
+        return normalize_date(value)
+    if field == 'nct_id':
+        return value.upper()
+    return value.lower()
+
+
+def read_trial_fields(filename):
+    # regex scan of the structured fields, far cheaper than the BeautifulSoup parse in read_trial
+    with open(filename, 'r') as f:
+        trial_data = f.read()
+    trial = {'file': filename}
+    for field in fields:
+        values = [normalize_value(field, v) for v in field_patterns[field].findall(trial_data) if v.strip()]
+        if field == 'condition':
+            trial[field] = values
+        else:
+            trial[field] = values[0] if values else None
+    if trial['nct_id'] is None:
+        trial['nct_id'] = os.path.splitext(os.path.basename(filename))[0].upper()
+    return trial
+
+
+def parse_where(where):
+    # "phase in (2, 2/3) and overall_status = Recruiting and condition ~ steatohepatitis and start_date >= 2015"
+    # Clauses are joined with "and"; operators are =, !=, <, <=, >, >=, in, not in and ~ (contains).
+    # Values with spaces are quoted. String comparisons are case insensitive.
+    clauses = []
+    position = 0
+    where = where.strip()
+    while position < len(where):
+        match = clause_pattern.match(where, position)
+        if match is None:
+            raise ValueError('Invalid -where expression at: {}'.format(where[position:]))
+        field, op, value, joiner = match.groups()
+        field = field.lower()
+        op = ' '.join(op.lower().split())
+        if field not in fields:
+            raise ValueError('Unknown -where field: {} (available: {})'.format(field, ', '.join(fields)))
+        if op in ('in', 'not in'):
+            if not value.startswith('('):
+                raise ValueError('Expected a (...) list after {} in -where expression'.format(op))
+            values = [v.strip().strip('"\'') for v in value[1:-1].split(',') if v.strip()]
+        else:
+            values = [value.strip('"\'')]
+        clauses.append((field, op, [normalize_value(field, v) for v in values]))
+        position = match.end()
+        if joiner == '' and position < len(where):
+            raise ValueError('Invalid -where expression at: {}'.format(where[position:]))
+        if joiner != '' and position >= len(where):
+            raise ValueError('Invalid -where expression at: {}'.format(where[match.start(4):]))
+    return clauses
+
+
+def _compare(actual, op, values):
+    if op == '=':
+        return actual == values[0]
+    if op == '!=':
+        return actual != values[0]
+    if op == '<':
+        return actual < values[0]
+    if op == '<=':
+        return actual <= values[0]
+    if op == '>':
+        return actual > values[0]
+    if op == '>=':
+        return actual >= values[0]
+    if op == 'in':
+        return actual in values
+    if op == 'not in':
+        return actual not in values
+    return values[0] in actual
+
+
+def where_matches(clauses, trial):
+    # trial: the fields returned by read_trial_fields; a missing field never matches (like NULL in SQL)
+    for field, op, values in clauses:
+        if field == 'condition':
+            if op in ('!=', 'not in'):
+                positive_op = '=' if op == '!=' else 'in'
+                if any(_compare(c, positive_op, values) for c in trial['condition']):
+                    return False
+            elif not any(_compare(c, op, values) for c in trial['condition']):
+                return False
+        elif trial[field] is None or not _compare(trial[field], op, values):
+            return False
+    return True
+
+
+def _clause_sql(field, op, values):
+    if op in ('in', 'not in'):
+        sql = '{} {} ({})'.format('{}', op.upper(), ', '.join('?' for _ in values))
+    elif op == '~':
+        sql = 'instr({}, ?) > 0'
+    else:
+        sql = '{} ' + op + ' ?'
+    if field != 'condition':
+        return sql.format(field), list(values)
+    # a trial matches when any of its conditions does; != and not in exclude trials with a matching condition
+    negate = op in ('!=', 'not in')
+    if negate:
+        sql = sql.replace('!=', '=').replace('NOT IN', 'IN')
+    subquery = 'nct_id {}IN (SELECT nct_id FROM conditions WHERE {})'.format('NOT ' if negate else '', sql.format('condition'))
+    return subquery, list(values)
+
+
+def where_sql(clauses):
+    parts = []
+    params = []
+    for field, op, values in clauses:
+        sql, clause_params = _clause_sql(field, op, values)
+        parts.append(sql)
+        params.extend(clause_params)
+    return ' AND '.join(parts) or '1', params
+
+
+class TrialIndex:
+    # SQLite sidecar holding the structured fields of every trial file, so that -where selections over
+    # the full dump are answered by indexed queries instead of reading every xml file again.
+    # build() only rescans files whose modification time changed since the last build.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with connect(self.db_path) as conn:
+            conn.executescript(schema)
+
+    def build(self, files):
+        start = time.time()
+        with connect(self.db_path) as conn:
+            known = {row['file']: (row['nct_id'], row['mtime'])
+                     for row in conn.execute('SELECT nct_id, file, mtime FROM trials')}
+            conn.execute('BEGIN IMMEDIATE')
+            seen = set()
+            inserted = set()
+            updated = 0
+            for filename in files:
+                seen.add(filename)
+                mtime = os.stat(filename).st_mtime
+                if filename in known and known[filename][1] == mtime:
+                    continue
+                trial = read_trial_fields(filename)
+                if filename in known:
+                    conn.execute('DELETE FROM conditions WHERE nct_id = ?', (known[filename][0],))
+                conn.execute('DELETE FROM conditions WHERE nct_id = ?', (trial['nct_id'],))
+                conn.execute('INSERT OR REPLACE INTO trials (nct_id, file, mtime, phase, overall_status, study_type, '
+                             'start_date) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (trial['nct_id'], filename, mtime, trial['phase'], trial['overall_status'],
+                              trial['study_type'], trial['start_date']))
+                conn.executemany('INSERT INTO conditions (nct_id, condition) VALUES (?, ?)',
+                                 [(trial['nct_id'], c) for c in trial['condition']])
+                inserted.add(trial['nct_id'])
+                updated += 1
+            # a trial file that moved (e.g. into its shard directory) was inserted again under its new name,
+            # which already replaced the row of the old one
+            removed = [(filename, nct_id) for filename, (nct_id, _) in known.items() if filename not in seen]
+            conn.executemany('DELETE FROM trials WHERE file = ?', [(filename,) for filename, _ in removed])
+            conn.executemany('DELETE FROM conditions WHERE nct_id = ?',
+                             [(nct_id,) for _, nct_id in removed if nct_id not in inserted])
+            conn.execute('COMMIT')
+        logging.info('Trial index: {} trials indexed, {} removed, {:.1f}s'.format(updated, len(removed), time.time() - start))
+
+    def select(self, clauses, directory=None):
+        # returns the (nct_id, file) of the matching trials in NCT ID order, only those below directory if given
+        sql, params = where_sql(clauses)
+        with connect(self.db_path) as conn:
+            rows = conn.execute('SELECT nct_id, file FROM trials WHERE {} ORDER BY nct_id'.format(sql), params).fetchall()
+        selected = [(row['nct_id'], row['file']) for row in rows]
+        if directory is None:
+            return selected
+        prefix = os.path.join(os.path.abspath(directory), '')
+        inside = [(nct_id, filename) for nct_id, filename in selected if os.path.abspath(filename).startswith(prefix)]
+        if len(inside) < len(selected):
+            logging.warning('Trial index: {} matching trials are not below {} and were skipped (index built for another '
+                            'directory?)'.format(len(selected) - len(inside), directory))
+        return inside
+
+    def __len__(self):
+        with connect(self.db_path) as conn:
+            return conn.execute('SELECT COUNT(*) FROM trials').fetchone()[0]
@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import logging
+import threading
+
+
+nct_id_pattern = re.compile(r'<nct_id>\s*(.*?)\s*</nct_id>', re.S)
+phase_pattern = re.compile(r'<phase>\s*(.*?)\s*</phase>', re.S)
+
+
+def normalize_phase(phase_text):
+    # "Phase 2/Phase 3" -> "2/3", "Phase 1" -> "1", "N/A" -> "n/a"
+    phases = []
+    for p in phase_text.split('/'):
+        p = p.lower().strip()
+        if 'phase' in p:
+            p = p.split('phase')[1].strip()
+        phases.append(p)
+    return '/'.join(phases)
+
+
+def read_trial_summary(filename):
+    # cheap regex scan so that ordering the queue does not need a full xml parse of every trial
+    with open(filename, 'r') as f:
+        trial_data = f.read()
+    nct_match = nct_id_pattern.search(trial_data)
+    phase_match = phase_pattern.search(trial_data)
+    trial_id = nct_match.group(1) if nct_match else os.path.splitext(os.path.basename(filename))[0]
+    phase = normalize_phase(phase_match.group(1)) if phase_match else 'na'
+    return {'file': filename, 'trial_id': trial_id, 'phase': phase}
+
+
+def load_priority_spec(priority_file=None, priority_phases=None):
+    # priority_file: text file with one NCT ID per line (blank lines and '#' comments are ignored)
+    # priority_phases: comma separated phase values in priority order, e.g. "3,2/3"
+    spec = {'trial_ids': [], 'phases': []}
+    if priority_file is not None:
+        with open(priority_file, 'r') as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    spec['trial_ids'].append(line.upper())
+    if priority_phases is not None:
+        spec['phases'] = [normalize_phase(p) for p in priority_phases.split(',') if p.strip()]
+    return spec
+
+
+def order_trials(summaries, spec):
+    # trials from the ID list come first (in list order), then trials matching the
+    # priority phases (in phase order), then everything else; ties are broken by trial ID
+    id_rank = {trial_id: i for i, trial_id in enumerate(spec['trial_ids'])}
+    phase_rank = {phase: i for i, phase in enumerate(spec['phases'])}
+
+    def priority_key(summary):
+        if summary['trial_id'] in id_rank:
+            return 0, id_rank[summary['trial_id']], summary['trial_id']
+        if summary['phase'] in phase_rank:
+            return 1, phase_rank[summary['phase']], summary['trial_id']
+        return 2, 0, summary['trial_id']
+
+    return sorted(summaries, key=priority_key)
+
+
+class TokenBudget:
+    def __init__(self, max_tokens=None):
+        self.max_tokens = max_tokens
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def add(self, n_tokens):
+        # llm calls can run in several threads (-stream)
+        with self._lock:
+            self.spent += n_tokens
+
+    def exhausted(self):
+        return self.max_tokens is not None and self.spent >= self.max_tokens
+
+    def remaining(self):
+        if self.max_tokens is None:
+            return None
+        return max(self.max_tokens - self.spent, 0)
+
+
+class TrialQueue:
+    # The pending trials are written to a json state file once per run, and every finished trial is
+    # appended to a done log next to it (<state file>.done), so that a run stopped at the token budget
+    # (or killed) resumes with the remaining trials next time without rewriting the queue per trial.
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.done_file = state_file + '.done' if state_file is not None else None
+        self.pending = []
+        self.completed = set()
+        self.completed_files = set()
+        self._pending_ids = set()
+        self._remaining = 0
+
+    def load(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return False
+        with open(self.state_file, 'r') as f:
+            state = json.load(f)
+        self.completed = set(state.get('completed', []))
+        self.completed_files = set(state.get('completed_files', []))
+        if os.path.exists(self.done_file):
+            with open(self.done_file, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        trial_id, filename = line.rstrip('\n').split('\t', 1)
+                        self.completed.add(trial_id)
+                        self.completed_files.add(filename)
+        self._set_pending([s for s in state.get('pending', []) if s['trial_id'] not in self.completed])
+        return True
+
+    def save(self):
+        # compacts the done log into the state file
+        if self.state_file is None:
+            return
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'pending': self.pending, 'completed': sorted(self.completed),
+                       'completed_files': sorted(self.completed_files)}, f)
+        os.replace(tmp_path, self.state_file)
+        if os.path.exists(self.done_file):
+            os.remove(self.done_file)
+
+    def _set_pending(self, summaries):
+        self.pending = summaries
+        self._pending_ids = set(s['trial_id'] for s in summaries)
+        self._remaining = len(summaries)
+
+    def build(self, files, spec):
+        summaries = [read_trial_summary(filename) for filename in files]
+        self._set_pending(order_trials([s for s in summaries if s['trial_id'] not in self.completed], spec))
+        self.save()
+
+    def resume(self, files, spec):
+        # Brings a loaded queue in line with the current selection: trials no longer selected are
+        # dropped, newly selected files are added, and the queue is reordered by the current spec.
+        files = list(files)
+        selected = set(files)
+        queued_files = set(s['file'] for s in self.pending)
+        kept = [s for s in self.pending if s['file'] in selected]
+        new_files = [f for f in files if f not in queued_files and f not in self.completed_files]
+        added = [s for s in (read_trial_summary(f) for f in new_files) if s['trial_id'] not in self.completed]
+        if len(kept) < len(self.pending) or added:
+            logging.info('Scheduler: resumed queue updated to the current selection, {} trials dropped, {} added'.format(
+                len(self.pending) - len(kept), len(added)))
+        self._set_pending(order_trials(kept + added, spec))
+        self.save()
+
+    def __len__(self):
+        return self._remaining
+
+    def mark_done(self, summary):
+        if summary['trial_id'] in self.completed:
+            return
+        self.completed.add(summary['trial_id'])
+        self.completed_files.add(summary['file'])
+        if summary['trial_id'] in self._pending_ids:
+            self._remaining -= 1
+        if self.done_file is not None:
+            with open(self.done_file, 'a') as f:
+                f.write('{}\t{}\n'.format(summary['trial_id'], summary['file']))
+
+
+def schedule_trials(files, queue, spec, budget):
+    # Yields trial summaries in priority order until the queue is exhausted or the token
+    # budget is used up. The caller marks each trial with queue.mark_done() once its output
+    # is written (trials can be held back while their sections wait in a packed request).
+    # Trials already started when the budget runs out are finished, so the budget can be
+    # overshot by the trials in flight.
+    if queue.load():
+        queue.resume(files, spec)
+    else:
+        queue.build(files, spec)
+    logging.info('Scheduler: {} trials queued, {} already completed'.format(len(queue), len(queue.completed)))
+
+    for summary in queue.pending:
+        if budget.exhausted():
+            logging.info('Scheduler: token budget of {} reached ({} spent), {} trials left in queue'.format(
+                budget.max_tokens, budget.spent, len(queue)))
+            break
+        yield summary
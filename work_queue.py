@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from sqlite_util import connect
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS trials (
+    trial_id TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS trials_status_priority ON trials (status, priority);
+CREATE TABLE IF NOT EXISTS results (
+    trial_id TEXT PRIMARY KEY,
+    worker TEXT NOT NULL,
+    rows TEXT NOT NULL,
+    completed REAL NOT NULL
+);
+"""
+
+
+def default_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    # Trial work queue in a single SQLite file that any number of worker processes, on one
+    # or several hosts sharing the file, can claim trials from. A claim is a lease that the
+    # worker keeps alive with heartbeats; leases that expire (crashed or stalled worker) are
+    # handed to the next worker that asks for work. Results are stored in the same file.
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with connect(self.db_path) as conn:
+            conn.executescript(schema)
+
+    def _transaction(self, conn):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers cannot claim the same trial
+        conn.execute('BEGIN IMMEDIATE')
+
+    def enqueue(self, summaries):
+        # summaries in priority order (see trial_scheduler.order_trials); trials already queued keep their state
+        now = time.time()
+        with connect(self.db_path) as conn:
+            self._transaction(conn)
+            offset = conn.execute('SELECT COALESCE(MAX(priority) + 1, 0) FROM trials').fetchone()[0]
+            conn.executemany('INSERT OR IGNORE INTO trials (trial_id, file, priority, updated) VALUES (?, ?, ?, ?)',
+                             [(s['trial_id'], s['file'], offset + i, now) for i, s in enumerate(summaries)])
+            conn.execute('COMMIT')
+
+    def reclaim_expired(self, conn, now):
+        expired = conn.execute("SELECT trial_id, worker, attempts FROM trials WHERE status = 'leased' AND lease_expires < ?",
+                               (now,)).fetchall()
+        for row in expired:
+            status = 'failed' if row['attempts'] >= self.max_attempts else 'pending'
+            logging.warning('Work queue: lease of trial {} held by {} expired, marking {}'.format(
+                row['trial_id'], row['worker'], status))
+            conn.execute("UPDATE trials SET status = ?, worker = NULL, lease_expires = NULL, updated = ? "
+                         "WHERE trial_id = ? AND status = 'leased'", (status, now, row['trial_id']))
+
+    def claim(self, worker_id):
+        # returns {'trial_id', 'file'} of the highest priority pending trial, or None when nothing is left
+        now = time.time()
+        with connect(self.db_path) as conn:
+            self._transaction(conn)
+            self.reclaim_expired(conn, now)
+            row = conn.execute("SELECT trial_id, file FROM trials WHERE status = 'pending' ORDER BY priority LIMIT 1").fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute("UPDATE trials SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                         "updated = ? WHERE trial_id = ?", (worker_id, now + self.lease_seconds, now, row['trial_id']))
+            conn.execute('COMMIT')
+            return {'trial_id': row['trial_id'], 'file': row['file']}
+
+    def next_lease_expiry(self):
+        # earliest expiry time of the claimed trials, or None when no trial is claimed
+        with connect(self.db_path) as conn:
+            return conn.execute("SELECT MIN(lease_expires) FROM trials WHERE status = 'leased'").fetchone()[0]
+
+    def claim_next(self, worker_id, poll_seconds=30):
+        # Like claim(), but while other workers still hold leases it waits for them instead of
+        # returning None: a lease that expires (crashed worker) is then reclaimed by this worker.
+        # Returns None once no trial is pending or claimed.
+        while True:
+            claimed = self.claim(worker_id)
+            if claimed is not None:
+                return claimed
+            expires = self.next_lease_expiry()
+            if expires is None:
+                return None
+            time.sleep(min(max(expires - time.time(), 0) + 0.1, poll_seconds))
+
+    def heartbeat(self, worker_id, trial_id):
+        # extends the lease; returns False if the lease was lost to another worker
+        now = time.time()
+        with connect(self.db_path) as conn:
+            cursor = conn.execute("UPDATE trials SET lease_expires = ?, updated = ? "
+                                  "WHERE trial_id = ? AND worker = ? AND status = 'leased'",
+                                  (now + self.lease_seconds, now, trial_id, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, worker_id, trial_id, rows):
+        # rows: list of output records for the trial; the first result stored for a trial wins
+        now = time.time()
+        with connect(self.db_path) as conn:
+            self._transaction(conn)
+            status = conn.execute('SELECT status FROM trials WHERE trial_id = ?', (trial_id,)).fetchone()
+            if status is not None and status['status'] == 'done':
+                conn.execute('COMMIT')
+                logging.warning('Work queue: trial {} was already completed by another worker'.format(trial_id))
+                return False
+            conn.execute('INSERT OR REPLACE INTO results (trial_id, worker, rows, completed) VALUES (?, ?, ?, ?)',
+                         (trial_id, worker_id, json.dumps(rows), now))
+            conn.execute("UPDATE trials SET status = 'done', worker = ?, lease_expires = NULL, updated = ? WHERE trial_id = ?",
+                         (worker_id, now, trial_id))
+            conn.execute('COMMIT')
+            return True
+
+    def release(self, worker_id, trial_id, failed=False):
+        # gives a claimed trial back (or marks it failed, e.g. when it cannot be parsed); a trial
+        # given back after max_attempts claims is marked failed too
+        now = time.time()
+        with connect(self.db_path) as conn:
+            conn.execute("UPDATE trials SET status = CASE WHEN ? OR attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "worker = NULL, lease_expires = NULL, updated = ? "
+                         "WHERE trial_id = ? AND worker = ? AND status = 'leased'",
+                         (int(failed), self.max_attempts, now, trial_id, worker_id))
+
+    def counts(self):
+        with connect(self.db_path) as conn:
+            return {row['status']: row['n'] for row in conn.execute('SELECT status, COUNT(*) AS n FROM trials GROUP BY status')}
+
+    def results(self):
+        # yields (trial_id, rows) in queue priority order
+        with connect(self.db_path) as conn:
+            for row in conn.execute('SELECT r.trial_id, r.rows FROM results r JOIN trials t ON t.trial_id = r.trial_id '
+                                    'ORDER BY t.priority'):
+                yield row['trial_id'], json.loads(row['rows'])
+
+
+class LeaseKeeper:
+    # Background thread that heartbeats the lease of the trial a worker is processing.
+    def __init__(self, work_queue, worker_id, trial_id, interval=None):
+        self.work_queue = work_queue
+        self.worker_id = worker_id
+        self.trial_id = trial_id
+        self.interval = interval if interval is not None else work_queue.lease_seconds / 3.0
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.work_queue.heartbeat(self.worker_id, self.trial_id):
+                    logging.warning('Work queue: lost lease on trial {}'.format(self.trial_id))
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                logging.error('Work queue: heartbeat failed for trial {}: {}'.format(self.trial_id, e))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        return False
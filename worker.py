@@ -0,0 +1,23 @@
+import argparse
+import logging
+import eligibility_criteria_extraction as extraction
+from work_queue import WorkQueue, default_worker_id
+
+
+# Slim entry point for work queue workers: only the arguments a worker needs, and none of the
+# heavy libraries (pandas, langchain, nltk, bs4) are imported before the first trial is claimed.
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Claim trials from a shared work queue and extract their eligibility criteria.')
+    parser.add_argument('-work_queue', '--work_queue_file', required=True,
+                        help='SQLite work queue file filled with eligibility_criteria_extraction.py -enqueue')
+    extraction.add_common_arguments(parser)
+    args = parser.parse_args()
+
+    extraction.configure_run(args)
+    work_queue = WorkQueue(args.work_queue_file, lease_seconds=args.lease_seconds)
+    extraction.run_queue_worker(work_queue, args.worker_id or default_worker_id(), extraction.num_retries,
+                                extraction.delay_time, extraction.max_tokens, extraction.chunk_size)
+    logging.info('Work queue status: {}'.format(work_queue.counts()))
+    for line in extraction.run_report():
+        logging.info(line)